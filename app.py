@@ -1,10 +1,12 @@
 import time
+import threading
 
 import dash
 from dash import dcc
 from dash import html
+from dash import Patch
 import numpy as np
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, MATCH
 import json
 import dash_bootstrap_components as dbc
 from dash.exceptions import PreventUpdate
@@ -69,6 +71,9 @@ app.title = "Bayesian Mass Explorer"
 
 server = app.server
 
+# Fill the landscape figure cache in the background so new tabs are memory reads
+threading.Thread(target=figs.warm_landscape_cache, daemon=True).start()
+
 app.layout = html.Div(
     children=[
         dcc.Location(id='url', refresh=False),
@@ -101,7 +106,7 @@ app.layout = html.Div(
         dcc.Store(id='intermediate-value'),
         dcc.Store(id='nextgraphid', data=2),
         dcc.Store(id='viewsmemory', storage_type='memory',
-        data=json.dumps([{"graphstyle": 'landscape', "quantity": 'BE', "dataset": 'EXP', "colorbar": 'linear', "wigner": 0, "id": 1, 
+        data=json.dumps([{"graphstyle": 'landscape', "quantity": 'BE', "dataset": 'EXP', "colorbar": 'linear', "wigner": 0, "nuclei": 'even', "compare": [], "id": 1, 
         "ZRange": {"zmin": None, "zmax": None, "protons": 40}, "NRange": {"nmin": None, "nmax": None, "neutrons": 40}}]),
         ),
         dcc.Store(id='triggerGraph', data=json.dumps("update")),
@@ -413,6 +418,8 @@ def quantity_options(is_chain,url):
         Output("zmax", "value"),
         Output("nmin", "value"),
         Output("nmax", "value"),
+        Output("dropdown-nuclei", "value"),
+        Output("dropdown-compare", "value"),
     ],
     [
         State("viewsmemory", "data"),
@@ -438,12 +445,14 @@ def quantity_options(is_chain,url):
         Input("neutrons", "value"),
         Input("dropdown-colorbar","value"),
         Input("radio-wigner","value"),
+        Input("dropdown-nuclei","value"),
+        Input("dropdown-compare","value"),
     ]
 )
 def main_update(
     json_cur_views, cur_tabs, tab_n, new_button, graphid, 
     delete_button, reset_button, graphstyle, quantity, dataset, zmin, 
-    zmax, nmin, nmax, protons, neutrons, colorbar, wigner):
+    zmax, nmin, nmax, protons, neutrons, colorbar, wigner, nuclei, compare):
     cur_views = json.loads(json_cur_views)
     n = int(tab_n[3])
     #print(base64.urlsafe_b64encode(json_cur_views.encode()).decode())
@@ -467,6 +476,8 @@ def main_update(
             cur_views[n-1]['ZRange']['zmax'],
             cur_views[n-1]['NRange']['nmin'],
             cur_views[n-1]['NRange']['nmax'],
+            cur_views[n-1].get('nuclei', 'even'),
+            cur_views[n-1].get('compare', []),
         ]
 
     #new_plot
@@ -474,7 +485,7 @@ def main_update(
         if len(cur_tabs)>3 or type(new_button) != type(1):
             raise PreventUpdate
         new_views = cur_views
-        default = {"graphstyle": 'landscape', "quantity": 'BE', "dataset": 'EXP', "colorbar": 'linear', "wigner": 0, "id": graphid, 
+        default = {"graphstyle": 'landscape', "quantity": 'BE', "dataset": 'EXP', "colorbar": 'linear', "wigner": 0, "nuclei": 'even', "compare": [], "id": graphid, 
         "ZRange": {"zmin": None, "zmax": None, "protons": 40}, "NRange": {"nmin": None, "nmax": None, "neutrons": 40}}
         new_views.append(default)
         new_tabs = cur_tabs
@@ -500,6 +511,8 @@ def main_update(
             new_views[-1]['ZRange']['zmax'],
             new_views[-1]['NRange']['nmin'],
             new_views[-1]['NRange']['nmax'],
+            new_views[-1].get('nuclei', 'even'),
+            new_views[-1].get('compare', []),
         ]
  
     #delete_plot
@@ -524,13 +537,15 @@ def main_update(
                 new_views[-1]['ZRange']['zmax'],
                 new_views[-1]['NRange']['nmin'],
                 new_views[-1]['NRange']['nmax'],
+                new_views[-1].get('nuclei', 'even'),
+                new_views[-1].get('compare', []),
             ]
         else:
             raise PreventUpdate
     
     #reset_page
     if "reset-button" == dash.callback_context.triggered_id:
-        new_views = [{"graphstyle": 'landscape', "quantity": 'BE', "dataset": 'EXP', "colorbar": 'linear', "wigner": 0, "id": 1, 
+        new_views = [{"graphstyle": 'landscape', "quantity": 'BE', "dataset": 'EXP', "colorbar": 'linear', "wigner": 0, "nuclei": 'even', "compare": [], "id": 1, 
         "ZRange": {"zmin": None, "zmax": None, "protons": 40}, "NRange": {"nmin": None, "nmax": None, "neutrons": 40}}]
         return [
             json.dumps(new_views), 
@@ -547,6 +562,8 @@ def main_update(
             None,
             None,
             None,
+            'even',
+            [],
         ]
 
     #dropdown_input
@@ -563,6 +580,10 @@ def main_update(
         new_views[n-1]['colorbar'] = colorbar
     if "radio-wigner" == dash.callback_context.triggered_id:
         new_views[n-1]['wigner'] = wigner
+    if "dropdown-nuclei" == dash.callback_context.triggered_id:
+        new_views[n-1]['nuclei'] = nuclei
+    if "dropdown-compare" == dash.callback_context.triggered_id:
+        new_views[n-1]['compare'] = compare
     if "zmin" == dash.callback_context.triggered_id:
         new_views[n-1]['ZRange']['min'] = zmin
     if "zmax" == dash.callback_context.triggered_id:
@@ -575,10 +596,14 @@ def main_update(
         new_views[n-1]['ZRange']['protons'] = protons
     if "neutrons" == dash.callback_context.triggered_id:
         new_views[n-1]['NRange']['neutrons'] = neutrons
+    # Restyling a graph only patches the figure that is already on the page
+    trigger = "update"
+    if dash.callback_context.triggered_id in patch_inputs:
+        trigger = {"action": "patch", "view": n-1, "input": dash.callback_context.triggered_id}
     return [
         json.dumps(new_views), 
         cur_tabs, 
-        json.dumps("update"), 
+        json.dumps(trigger), 
         tab_n, 
         graphid,
         graphstyle, 
@@ -589,10 +614,47 @@ def main_update(
         zmin, 
         zmax, 
         nmin, 
-        nmax
+        nmax,
+        nuclei,
+        compare,
     ]
 
 
+patch_inputs = ["dropdown-colorbar", "radio-wigner", "dropdown-select-quantity"]
+
+# Patch of the figure at div-graphs children[i] after one of patch_inputs
+# changed, None when the view has to be rebuilt instead
+def patch_view(patch, i, view_dict, changed):
+    view = views.View(view_dict)
+    figure = patch[i]["props"]["figure"]
+    if view.quantity == 'All':
+        return None
+    if view.graphstyle == 'landscape':
+        if len(figs.chain_models(view.dataset)) > 1:
+            return None
+        fig = figs.landscape_json(view.quantity, view.dataset, view.colorbar, view.wigner, view.ZRange, view.NRange, getattr(view, 'nuclei', 'even'))
+        trace = fig["data"][0]
+        # A zoomed graph holds the window's arrays and color range, so the
+        # overview data always comes back with the overview axes
+        for key in ["x", "y", "z", "zmin", "zmax", "colorscale", "text"]:
+            if key in trace:
+                figure["data"][0][key] = trace[key]
+        if changed != "dropdown-colorbar":
+            figure["layout"]["title"]["text"] = fig["layout"]["title"]["text"]
+        figure["layout"]["xaxis"]["range"] = fig["layout"]["xaxis"]["range"]
+        figure["layout"]["yaxis"]["range"] = fig["layout"]["yaxis"]["range"]
+        return patch
+    if view.graphstyle in ['isotopic', 'isotonic']:
+        if changed == "dropdown-colorbar":
+            return patch
+        fig = getattr(figs, view.graphstyle)(view.quantity, figs.chain_selection(view.dataset, getattr(view, 'compare', None)), view.colorbar, view.wigner, view.ZRange, view.NRange)
+        for k in range(len(fig.data)):
+            figure["data"][k]["x"] = fig.data[k].x
+            figure["data"][k]["y"] = fig.data[k].y
+        figure["layout"]["yaxis"]["title"]["text"] = fig.layout.yaxis.title.text
+        return patch
+    return None
+
 @app.callback(
     Output("div-graphs", "children"),
     [
@@ -606,7 +668,14 @@ def main_output(
     json_views,
     #relayout_data
 ):
-    if(json.loads(trigger)=="update"):
+    trigger = json.loads(trigger)
+    if isinstance(trigger, dict) and trigger["action"] == "patch":
+        views_list = json.loads(json_views)
+        patch = patch_view(Patch(), trigger["view"], views_list[trigger["view"]], trigger["input"])
+        if patch is not None:
+            return patch
+        trigger = "update"
+    if(trigger=="update"):
         output = []
         views_list = json.loads(json_views) # list of dicts
         print("OUT ", views_list)
@@ -629,6 +698,44 @@ def main_output(
     #         outputs.append(fig)
     #     return outputs
 
+# Zooming a landscape swaps the coarse overview for a full-resolution chart
+# of the visible window, colored by the nuclei inside it; resetting the axes
+# brings the cached overview back
+@app.callback(
+    Output({'type': 'landscape-graph', 'index': MATCH}, 'figure'),
+    Input({'type': 'landscape-graph', 'index': MATCH}, 'relayoutData'),
+    [
+        State({'type': 'landscape-graph', 'index': MATCH}, 'id'),
+        State("viewsmemory", "data"),
+    ],
+    prevent_initial_call=True
+)
+def landscape_zoom(relayout_data, graph_id, json_views):
+    if relayout_data is None:
+        raise PreventUpdate
+    view = None
+    for view_dict in json.loads(json_views):
+        if view_dict["id"] == graph_id["index"]:
+            view = view_dict
+    if view is None or view["graphstyle"] != 'landscape':
+        raise PreventUpdate
+    nuclei = view.get("nuclei", 'even')
+    if relayout_data.get("xaxis.autorange") or relayout_data.get("yaxis.autorange"):
+        return figs.landscape_json(view["quantity"], view["dataset"], view["colorbar"], view["wigner"], view["ZRange"], view["NRange"], nuclei)
+    # A horizontal or vertical drag only sends the axis it zoomed, the other
+    # one spans the whole chart
+    ranges = {}
+    for axis in ["xaxis", "yaxis"]:
+        if axis+".range" in relayout_data:
+            ranges[axis] = relayout_data[axis+".range"]
+        elif axis+".range[0]" in relayout_data and axis+".range[1]" in relayout_data:
+            ranges[axis] = [relayout_data[axis+".range[0]"], relayout_data[axis+".range[1]"]]
+    if not ranges:
+        raise PreventUpdate
+    nmin, nmax = ranges.get("xaxis", figs.landscape_nrange)
+    zmin, zmax = ranges.get("yaxis", figs.landscape_zrange)
+    return figs.landscape_window(view["quantity"], view["dataset"], view["colorbar"], view["wigner"], nmin, nmax, zmin, zmax)
+
 # @app.callback([Output('graph2', 'figure')],
 #          [Input('graph', 'relayoutData')], # this triggers the event
 #          [State('graph2', 'figure')])
@@ -882,24 +989,84 @@ def main_output(
     Output('intermediate-value', 'data'),
     Output('div-graphs-loading', 'children'),
     Input('submit-gpe', 'n_clicks'),
+    Input("dropdown-select-dataset", "value"),
+    Input("dropdown-select-quantity", "value"),
     [
         State("eta","value"),
         State("rhon","value"),
         State("rhoz","value"),
+        State("dropdown-gp-method","value"),
+        State("inducing","value"),
         State('div-graphs-loading','children'),
     ],
     prevent_initial_call=True
 )
-def update_GP_json(n_clicks, eta, rhon, rhoz, old_out):
+def update_GP_json(n_clicks, dataset, quantity, eta, rhon, rhoz, method, inducing, old_out):
     t_start = time.time()
     model = [eta, rhon, rhoz]
-    if(model == gpe.default_model):
-        return json.dumps(gpe.gp_output.tolist()), [old_out[0]]
-    gp_out = gpe.update_GP(model)
-    gp_json = json.dumps(gp_out.tolist())
+    if method == 'sparse' and not inducing:
+        method = 'exact'
+    try:
+        token = gpe.gp_token(model, dataset, quantity, method, inducing)
+    except ValueError as e:
+        return dash.no_update, [old_out[0], html.P(str(e))]
+    if(model == gpe.default_model and dataset == 'FRDM' and quantity == 'TwoNSE' and method == 'exact'):
+        return token, [old_out[0]]
+    timings = {}
+    try:
+        gp_out = gpe.token_GP(token, timings)
+    except ValueError as e:
+        return dash.no_update, [old_out[0], html.P(str(e))]
     t_stop = time.time()
-    train_out = [html.P("Trained! Took {:.4f} seconds!".format(t_stop-t_start))]
-    return gp_json, [old_out[0]]+train_out
+    if timings['cached']:
+        train_out = [html.P("Loaded from the {} cache in {:.4f} seconds!".format(timings['cached'], t_stop-t_start))]
+    elif 'refit' in timings:
+        train_out = [html.P("Trained! Took {:.4f} seconds!".format(t_stop-t_start)),
+            html.P("Updated the previous fit to the new data in {:.4f} s, prediction {:.4f} s".format(timings['refit'], timings['predict']))]
+    elif method == 'sparse':
+        train_out = [html.P("Trained! Took {:.4f} seconds!".format(t_stop-t_start)),
+            html.P("Sparse fit on {} nuclei {:.4f} s, prediction {:.4f} s".format(int(inducing), timings['factor'], timings['predict']))]
+    elif method == 'kronecker':
+        train_out = [html.P("Trained! Took {:.4f} seconds!".format(t_stop-t_start)),
+            html.P("Conjugate gradients {:.4f} s ({} iterations), prediction {:.4f} s".format(timings['factor'], timings['iterations'], timings['predict']))]
+    else:
+        train_out = [html.P("Trained! Took {:.4f} seconds!".format(t_stop-t_start)),
+            html.P("Kernel {:.4f} s, Cholesky {:.4f} s, prediction {:.4f} s".format(timings['kernel'], timings['factor'], timings['predict']))]
+    # The exact GP is only run for comparison while it stays affordable
+    if method != 'exact' and len(gpe.gp_tables(dataset, quantity)[0]) <= gpe.exact_limit:
+        accuracy = gpe.approx_accuracy(gp_out, gpe.cached_GP(model, {}, dataset, quantity))
+        train_out.append(html.P("{} vs exact GP: RMS mean difference {:.4f} MeV (max {:.4f} MeV), RMS band difference {:.4f} MeV".format(
+            method.capitalize(), accuracy['rms_mean'], accuracy['max_mean'], accuracy['rms_band'])))
+    return token, [old_out[0]]+train_out
+
+@app.callback(
+    Output("eta","value"),
+    Output("rhon","value"),
+    Output("rhoz","value"),
+    Output('optimize-gpe-output', 'children'),
+    Input('optimize-gpe', 'n_clicks'),
+    [
+        State("eta","value"),
+        State("rhon","value"),
+        State("rhoz","value"),
+        State("dropdown-select-dataset", "value"),
+        State("dropdown-select-quantity", "value"),
+    ],
+    prevent_initial_call=True
+)
+def optimize_GP(n_clicks, eta, rhon, rhoz, dataset, quantity):
+    start = [eta, rhon, rhoz]
+    if None in start:
+        start = gpe.default_model
+    timings = {}
+    try:
+        model = gpe.optimize_GP(start, timings=timings, dataset=dataset, quantity=quantity)
+    except ValueError as e:
+        return dash.no_update, dash.no_update, dash.no_update, [html.P(str(e))]
+    model = [round(p, 4) for p in model]
+    optimize_out = [html.P("Optimized in {:.4f} seconds ({} likelihood evaluations), log likelihood {:.2f}".format(
+        timings['total'], timings['evaluations'], timings['lml']))]
+    return model[0], model[1], model[2], optimize_out
 
 # @app.callback(
 #     Output('div-graphs-loading', 'children'),
@@ -944,10 +1111,26 @@ def main_output_gpe(
     chain,
     NRange,
     ZRange,
-    gp_json,
+    gp_token,
 ):
     t_start = time.time()
-    gp_out = np.array(json.loads(gp_json))
+    # The GP results belong to the last training run, not to the dropdowns
+    trained = ('FRDM', 'TwoNSE')
+    try:
+        gp_out = gpe.token_GP(gp_token)
+        if gp_token is not None:
+            trained = (gp_token['dataset'], gp_token['quantity'])
+    except ValueError:
+        gp_out = np.asarray(gpe.gp_output)
+    untrained = [
+        html.Div(
+            children=[
+                html.P("Train the GP for "+str(dataset)+" "+bmex.OutputString(quantity)+" first, the current results are for "+\
+                    trained[0]+" "+bmex.OutputString(trained[1])+"."),
+            ],
+            style={'font-size':'3rem'},
+        ),
+    ]
     np.set_printoptions(precision=5)
     if(chain=='single'):
         if(N==None or Z==None):
@@ -978,6 +1161,8 @@ def main_output_gpe(
                     style={'font-size':'3rem'},
                 ),
             ]
+        elif (dataset, quantity) != trained:
+            return untrained
         else:
             result = gpe.gp_single(N,Z,gp_out)
             if isinstance(result, str):
@@ -1024,8 +1209,10 @@ def main_output_gpe(
                     style={'font-size':'3rem'},
                 ),
             ]
+        if (dataset, quantity) != trained:
+            return untrained
         #& (bmex.df["Z"]==Z1)
-        out_str = "Two Neutron Separation Energy"
+        out_str = bmex.OutputString(quantity)
         #model = [0.9, 1.529, 0.2533]
         #nmin = bmex.df[(bmex.df["Z"]==Z) & (bmex.df["Model"]==dataset)]['N'].min()
         #nmax = bmex.df[(bmex.df["Z"]==Z) & (bmex.df["Model"]==dataset)]['N'].max()
@@ -1086,11 +1273,23 @@ def main_output_gpe(
                     style={'font-size':'3rem'},
                 ),
             ]
-        func = getattr(bmex, quantity)
+        if (dataset, quantity) != trained:
+            return untrained
         out_str = bmex.OutputString(quantity)
-        #& (bmex.df["Z"]==Z1)
-        zmin = bmex.df[(bmex.df["N"]==N) & (bmex.df["Model"]==dataset)]["Z"].min()
-        zmax = bmex.df[(bmex.df["N"]==N) & (bmex.df["Model"]==dataset)]["Z"].max()
+        # The chain is checked against the GP results, which also cover the
+        # FRDM tables that have no bmex grid
+        chain_Z = gp_out[gp_out[:,0]==N][:,1] if bmex.NucleonIndex(N) is not None else []
+        if len(chain_Z) == 0:
+            return [
+                html.Div(
+                    id="graph-container",
+                    children=[
+                        html.P("No "+str(dataset)+" GP results for the isotonic chain N="+str(N)),
+                    ],
+                    style={'font-size':'3rem'},
+                )
+            ]
+        zmin, zmax = int(min(chain_Z)), int(max(chain_Z))
         if ZRange[0] < zmin:
             return [
                 html.Div(
@@ -1114,7 +1313,16 @@ def main_output_gpe(
                 )
             ]
         if (ZRange[0] >= zmin) and (ZRange[1] <= zmax):
-            isotone_chain = figs.isotone_chain(N, ZRange, dataset, out_str, func)
+            isotone_chain = gpe.gp_figure_isotonic(N,out_str,gp_out,ZRange[0],ZRange[1])
+            if isinstance(isotone_chain, str):
+                return [
+                    html.Div(
+                        children=[
+                            html.P(isotone_chain),
+                        ],
+                        style={'font-size':'3rem'},
+                    ),
+                ]
             return [
                 html.Div(
                     id="graph-container",
@@ -1,10 +1,15 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+
 import numpy as np
 import pandas as pd
 
-# Make dictionary of models and corresponding pandas dataframes
+import utils.store as store
+
 modelNames = ['EXP', 'ME2', 'MEdelta', 'PC1', 'NL3S', 'SKMS', 'SKP', 'SLY4', 'SV', 'UNEDF0', 'UNEDF1']
-models = [pd.read_hdf('utils/models.h5', n) for n in modelNames]
-data_dict = {modelNames[i]: models[i] for i in range(len(modelNames))}
 
 # Make dictionary to convert quantity code to full quantity name
 qinput = ['BE', 'OneNSE', 'OnePSE', 'TwoNSE', 'TwoPSE', 'AlphaSE', 'TwoNSGap', 'TwoPSGap', 'DoubleMDiff', 'N3PointOED', 'P3PointOED', 'SNESplitting', 'SPESplitting', 'WignerEC', 'QDB2t']
@@ -14,27 +19,378 @@ qnames = ['Binding_Energy_(MeV)', 'One Neutron Separation Energy', 'One Proton S
 'Single-Neutron Energy Splitting', 'Single-Proton Energy Splitting', 'Wigner Energy Coeffienct', 'Quad_Def_Beta2_total']
 q_dict = {qinput[j]: qnames[j] for j in range(len(qinput))}
 
+# Dense (quantity, Z, N) grid for each model, NaN where a nucleus is missing,
+# so single lookups are plain indexing and chains are array slices
+q_index = {qinput[j]: j for j in range(len(qinput))}
+
+def make_grid(df):
+    Z = df["Z"].to_numpy(dtype=int)
+    N = df["N"].to_numpy(dtype=int)
+    grid = np.full((len(qinput), Z.max()+1, N.max()+1), np.nan)
+    for j in range(len(qinput)):
+        if q_dict[qinput[j]] in df:
+            grid[j, Z, N] = pd.to_numeric(df[q_dict[qinput[j]]], errors='coerce')
+    return grid
+
+# Inverse of make_grid, one row per nucleus with any quantity available
+def grid_frame(grid):
+    Z, N = np.nonzero(~np.all(np.isnan(grid), axis=0))
+    df = pd.DataFrame({"Z": Z, "N": N})
+    for j in range(len(qinput)):
+        df[q_dict[qinput[j]]] = grid[j, Z, N]
+    return df
+
+# Read-only mapping of model name -> table that loads a model on first access
+# and evicts the least recently used ones once the resident tables exceed
+# budget bytes (the most recent model always stays resident). With a version
+# function every table is dropped as soon as the version it returns changes,
+# so a rewritten store is picked up without a restart.
+class ModelCache(Mapping):
+    def __init__(self, names, loader, budget, version=None):
+        self.names = list(names)
+        self.loader = loader
+        self.budget = budget
+        self.version = version
+        self.loaded_version = None
+        self.resident = OrderedDict()
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        with self.lock:
+            if self.version is not None:
+                current = self.version()
+                if current != self.loaded_version:
+                    self.resident.clear()
+                    self.loaded_version = current
+            if name in self.resident:
+                self.hits += 1
+                self.resident.move_to_end(name)
+                return self.resident[name]
+            table = self.loader(name)
+            self.loads += 1
+            self.resident[name] = table
+            while len(self.resident) > 1 and self.nbytes() > self.budget:
+                self.resident.popitem(last=False)
+                self.evictions += 1
+            return table
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def nbytes(self):
+        total = 0
+        for table in self.resident.values():
+            if isinstance(table, pd.DataFrame):
+                total += int(table.memory_usage(index=True).sum())
+            elif isinstance(table, dict):
+                total += sum(a.nbytes for a in table.values() if isinstance(a, np.ndarray))
+            else:
+                total += table.nbytes
+        return total
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "loads": self.loads, "evictions": self.evictions,
+                "resident": list(self.resident), "bytes": self.nbytes(), "budget": self.budget,
+                "version": self.loaded_version}
+
+# Per-cache memory budget, BMEX_MODEL_BUDGET_MB in the environment (default 64 MB)
+model_budget = int(float(os.environ.get("BMEX_MODEL_BUDGET_MB", 64))*2**20)
+
+# Models are memory-mapped from utils/store when it has been built
+# (python -m utils.store), otherwise read from utils/models.h5
+use_store = store.has_grids(modelNames, qinput)
+
+def read_grid(model):
+    if use_store:
+        return store.load_grid(model)
+    return make_grid(pd.read_hdf('utils/models.h5', model))
+
+# Ensemble statistics over the theory models, usable as datasets everywhere a
+# model name is. Values are kept in the stored sign convention, so STD and
+# SPREAD are stored negated and come out positive from QuanValue. CLOSEST
+# holds, per nucleus and quantity, the value of the model nearest to EXP.
+theoryNames = modelNames[1:]
+ensembleNames = ['MEAN', 'STD', 'SPREAD', 'CLOSEST']
+
+# Changes whenever any model table on disk changes
+def data_version():
+    if use_store:
+        files = [store.grid_path(m) for m in modelNames]
+    else:
+        files = ['utils/models.h5']
+    stats = [os.stat(f) for f in files]
+    key = "-".join("{:x}.{:x}".format(st.st_mtime_ns, st.st_size) for st in stats)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def compute_ensemble():
+    members = [read_grid(m) for m in theoryNames]
+    exp = read_grid('EXP')
+    shape = tuple(max(g.shape[k] for g in members+[exp]) for k in range(3))
+    def pad(g):
+        out = np.full(shape, np.nan)
+        out[:, :g.shape[1], :g.shape[2]] = g
+        return out
+    stack = np.stack([pad(g) for g in members])
+    exp = pad(exp)
+    available = ~np.all(np.isnan(stack), axis=0)
+    distance = np.where(np.isnan(stack), np.inf, np.abs(stack - exp))
+    closest = np.argmin(distance, axis=0)
+    with np.errstate(invalid='ignore'):
+        out = {
+            'MEAN': np.where(available, np.nanmean(np.where(available, stack, 0), axis=0), np.nan),
+            'STD': -np.where(available, np.nanstd(np.where(available, stack, 0), axis=0), np.nan),
+            'SPREAD': -(np.where(available, np.nanmax(np.where(available, stack, 0), axis=0), np.nan)
+                - np.where(available, np.nanmin(np.where(available, stack, 0), axis=0), np.nan)),
+            'CLOSEST': np.where(np.isfinite(np.min(distance, axis=0)),
+                np.take_along_axis(stack, closest[None], axis=0)[0], np.nan),
+        }
+    out['CLOSEST-index'] = np.where(np.isnan(out['CLOSEST']), -1, closest)
+    return out
+
+# Computed once per data version, kept in memory and in utils/store/ensemble
+ensemble_cache = {}
+ensemble_lock = threading.Lock()
+
+def ensemble_grids():
+    version = data_version()
+    with ensemble_lock:
+        if version not in ensemble_cache:
+            out = store.load_ensemble(ensembleNames+['CLOSEST-index'], version)
+            if out is None:
+                out = compute_ensemble()
+                try:
+                    store.write_ensemble(out, version)
+                except OSError:
+                    pass
+            ensemble_cache.clear()
+            ensemble_cache[version] = out
+        return ensemble_cache[version]
+
+# Name of the theory model closest to EXP for one nucleus, None when unknown
+def ClosestModel(N,Z,quan):
+    index = ensemble_grids()['CLOSEST-index']
+    N, Z = NucleonIndex(N), NucleonIndex(Z)
+    if N is None or Z is None:
+        return None
+    if 0 <= Z < index.shape[1] and 0 <= N < index.shape[2] and index[q_index[quan], Z, N] >= 0:
+        return theoryNames[int(index[q_index[quan], Z, N])]
+    return None
+
+# ClosestModel on the chart Z x N of QuanGrid, '' where unknown
+def ClosestModels(Z,N,quan):
+    index = ensemble_grids()['CLOSEST-index'][q_index[quan]]
+    Z, N = np.asarray(Z, dtype=int), np.asarray(N, dtype=int)
+    inside = (Z[:,None] < index.shape[0]) & (N[None,:] < index.shape[1])
+    found = np.where(inside, index[np.minimum(Z, index.shape[0]-1)[:,None], np.minimum(N, index.shape[1]-1)[None,:]], -1)
+    return np.array(['']+theoryNames, dtype=object)[found.astype(int)+1]
+
+def load_grid(model):
+    if model in ensembleNames:
+        return ensemble_grids()[model]
+    return read_grid(model)
+
+def load_frame(model):
+    if use_store or model in ensembleNames:
+        return grid_frame(grids[model])
+    return pd.read_hdf('utils/models.h5', model)
+
+# Make dictionary of models and corresponding pandas dataframes and grids,
+# reloaded whenever the tables on disk change
+data_dict = ModelCache(modelNames+ensembleNames, load_frame, model_budget, data_version)
+grids = ModelCache(modelNames+ensembleNames, load_grid, model_budget, data_version)
+
+# Populated range of every chain: for each quantity, the min/max N with data
+# at each Z and the min/max Z with data at each N, -1 where a chain is empty
+def chain_extents(grid):
+    valid = ~np.isnan(np.asarray(grid))
+    def bounds(axis):
+        size = valid.shape[axis]
+        present = valid.any(axis=axis)
+        lo = np.argmax(valid, axis=axis)
+        hi = size-1-np.argmax(np.flip(valid, axis=axis), axis=axis)
+        return np.where(present, lo, -1), np.where(present, hi, -1)
+    nmin, nmax = bounds(2)
+    zmin, zmax = bounds(1)
+    return {"nmin": nmin, "nmax": nmax, "zmin": zmin, "zmax": zmax}
+
+extents = ModelCache(modelNames+ensembleNames, lambda m: chain_extents(grids[m]), model_budget, data_version)
+
+# (Nmin, Nmax) of the isotopic chain Z, None when it has no data or Z is
+# not an integer
+def NExtent(Z,model,quan):
+    ext = extents[model]
+    j = q_index[quan]
+    Z = NucleonIndex(Z)
+    if Z is not None and 0 <= Z < ext["nmin"].shape[1] and ext["nmin"][j,Z] >= 0:
+        return int(ext["nmin"][j,Z]), int(ext["nmax"][j,Z])
+    return None
+
+# (Zmin, Zmax) of the isotonic chain N, None when it has no data or N is
+# not an integer
+def ZExtent(N,model,quan):
+    ext = extents[model]
+    j = q_index[quan]
+    N = NucleonIndex(N)
+    if N is not None and 0 <= N < ext["zmin"].shape[1] and ext["zmin"][j,N] >= 0:
+        return int(ext["zmin"][j,N]), int(ext["zmax"][j,N])
+    return None
+
+# Integer grid index of a nucleon number, None for anything that is not an
+# integral number (e.g. a cleared input box sends None)
+def NucleonIndex(x):
+    if isinstance(x, (bool, np.bool_)) or not isinstance(x, (int, float, np.integer, np.floating)):
+        return None
+    if not np.isfinite(x) or x != int(x):
+        return None
+    return int(x)
+
+# Raw stored value of quan for one nucleus, NaN when unavailable
+def GridValue(N,Z,model,quan):
+    grid = grids[model]
+    N, Z = NucleonIndex(N), NucleonIndex(Z)
+    if N is None or Z is None:
+        return np.nan
+    if 0 <= Z < grid.shape[1] and 0 <= N < grid.shape[2]:
+        return grid[q_index[quan], Z, N]
+    return np.nan
+
 # Retrieves single value
 def QuanValue(N,Z,model,quan,w=0):
-    df = data_dict[model]
-    try:
-        if w==3 and N==Z:
-            return np.round(float(df[(df["N"]==N) & (df["Z"]==Z)][q_dict[quan]])*float(df[(df["N"]==N) & (df["Z"]==Z)][q_dict['WignerEC']]),6)
-        else:
-            return np.round(float(df[(df["N"]==N) & (df["Z"]==Z)][q_dict[quan]]),6)*-1.0
-    except:
+    if w==3 and N==Z:
+        result = np.round(GridValue(N,Z,model,quan)*GridValue(N,Z,model,'WignerEC'),6)
+    else:
+        result = np.round(GridValue(N,Z,model,quan),6)*-1.0
+    if np.isnan(result):
         return "Error: "+str(model)+" data does not have "+OutputString(quan)+" available for Nuclei with N="+str(N)+" and Z="+str(Z)
+    return result
+
+# Vectorized QuanValue over arrays of N and Z, returns (values, valid) where
+# values is NaN wherever valid is False
+def QuanArray(N,Z,model,quan,w=0):
+    grid = grids[model]
+    # None and non-integral entries are treated as out of range
+    N, Z = np.broadcast_arrays(np.asarray(N, dtype=float), np.asarray(Z, dtype=float))
+    integral = np.isfinite(N) & np.isfinite(Z) & (N == np.floor(N)) & (Z == np.floor(Z))
+    N, Z = np.where(integral, N, -1).astype(int), np.where(integral, Z, -1).astype(int)
+    inside = (Z >= 0) & (Z < grid.shape[1]) & (N >= 0) & (N < grid.shape[2])
+    Zi, Ni = np.where(inside, Z, 0), np.where(inside, N, 0)
+    values = np.where(inside, np.round(grid[q_index[quan], Zi, Ni],6)*-1.0, np.nan)
+    if w==3:
+        wigner = (N==Z) & inside
+        values[wigner] = np.round(grid[q_index[quan], Zi[wigner], Ni[wigner]]*grid[q_index['WignerEC'], Zi[wigner], Ni[wigner]],6)
+    valid = ~np.isnan(values)
+    return values, valid
+
+# Every quantity of one nucleus in a single read, returns (values, valid)
+# ordered like qinput
+def QuanRecord(N,Z,model,w=0):
+    grid = grids[model]
+    N, Z = NucleonIndex(N), NucleonIndex(Z)
+    if N is None or Z is None or not (0 <= Z < grid.shape[1] and 0 <= N < grid.shape[2]):
+        values = np.full(len(qinput), np.nan)
+        return values, np.zeros(len(qinput), dtype=bool)
+    record = np.array(grid[:, Z, N])
+    if w==3 and N==Z:
+        values = np.round(record*record[q_index['WignerEC']],6)
+    else:
+        values = np.round(record,6)*-1.0
+    return values, ~np.isnan(values)
+
+# Extent of the nuclear chart drawn by the landscapes; nuclei beyond it are
+# neither shown nor counted in the colorscale percentiles
+chart_zmax = 104
+chart_nmax = 156
+
+# Whole chart of quan as (Z, N, values) with values[i,k] at (Z[i], N[k]) and
+# NaN for missing nuclei, cropped to the populated region inside chart_zmax
+# and chart_nmax. step=2 keeps only even-even nuclei.
+def QuanGrid(model,quan,w=0,step=1):
+    grid = grids[model][:, :chart_zmax+1, :chart_nmax+1]
+    Z = np.arange(0, grid.shape[1], step)
+    N = np.arange(0, grid.shape[2], step)
+    values = np.round(grid[q_index[quan], ::step, ::step],6)*-1.0
+    if w==3:
+        Zd, Nd = np.nonzero(Z[:,None]==N[None,:])
+        values[Zd, Nd] = np.round(grid[q_index[quan], Z[Zd], N[Nd]]*grid[q_index['WignerEC'], Z[Zd], N[Nd]],6)
+    valid = ~np.isnan(values)
+    rows = np.flatnonzero(valid.any(axis=1))
+    cols = np.flatnonzero(valid.any(axis=0))
+    if len(rows) == 0:
+        return Z[:0], N[:0], values[:0,:0]
+    rows = slice(rows[0], rows[-1]+1)
+    cols = slice(cols[0], cols[-1]+1)
+    return Z[rows], N[cols], values[rows, cols]
+
+# Percentile tables of every landscape (quantity, Wigner mode, even-even or
+# full chart), computed once when a model is loaded so colorscales are
+# lookups. Each table holds the values at quantile_levels.
+quantile_levels = np.linspace(0, 100, 1001)
+
+def quantile_table(model):
+    tables = {}
+    for quan in qinput:
+        for w in [0, 3]:
+            for step in [1, 2]:
+                values = QuanGrid(model, quan, w, step)[2]
+                values = values[~np.isnan(values)]
+                tables[(quan, w, step)] = np.percentile(values, quantile_levels) if len(values) else np.zeros(0)
+    return tables
+
+quantiles = ModelCache(modelNames+ensembleNames, quantile_table, model_budget, data_version)
+
+def Quantiles(model,quan,w=0,step=1):
+    return quantiles[model][(quan, 3 if w==3 else 0, step)]
+
+# Value below which p percent of the chart lies, NaN for an empty chart
+def Percentile(model,quan,p,w=0,step=1):
+    table = Quantiles(model,quan,w,step)
+    if len(table) == 0:
+        return np.nan
+    return np.interp(p, quantile_levels, table)
+
+# Positions in [0, 1] of the given percentiles of the values between 0 and
+# vmax, normalized by their range; this is the 'equal' colorbar, for any
+# number of color stops
+def EqualizedStops(model,quan,vmax,levels,w=0,step=1):
+    table = Quantiles(model,quan,w,step)
+    if len(table) == 0:
+        return np.asarray(levels)/100.0
+    # Fraction of the chart below 0 and below vmax, then percentiles of the
+    # values in between read off the same table
+    last = len(table)-1
+    lo = quantile_levels[min(np.searchsorted(table, 0, side='left'), last)]
+    hi = quantile_levels[max(np.searchsorted(table, vmax, side='right')-1, 0)]
+    vmin = np.interp(lo, quantile_levels, table)
+    values = np.interp(lo + np.asarray(levels)/100.0*(hi-lo), quantile_levels, table)
+    if vmax <= vmin:
+        return np.asarray(levels)/100.0
+    return values/(vmax-vmin)
 
 def IsotopicChain(Z,model,quan,divisibilty,w=0):
-    df = data_dict[model]
-    df = df[df["Z"]==Z]
-    df = df[df["N"]%divisibilty==0]
-    df[q_dict[quan]] = df[q_dict[quan]]*-1
-    return df[[q_dict[quan], "N"]]
+    grid = grids[model]
+    if not 0 <= Z < grid.shape[1]:
+        return pd.DataFrame({q_dict[quan]: [], "N": []})
+    N = np.arange(0, grid.shape[2], divisibilty)
+    values = grid[q_index[quan], Z, N]
+    valid = ~np.isnan(values)
+    return pd.DataFrame({q_dict[quan]: values[valid]*-1, "N": N[valid]})
 
 def IsotonicChain(N,model,quan,w=0):
-    df = data_dict[model]
-    return df[df["N"]==N][q_dict[quan]]
+    grid = grids[model]
+    if not 0 <= N < grid.shape[2]:
+        return pd.Series([], name=q_dict[quan], dtype=float)
+    values = grid[q_index[quan], :, N]
+    Z = np.flatnonzero(~np.isnan(values))
+    return pd.Series(values[Z], index=Z, name=q_dict[quan])
 
     
 # def BE(N1,Z1,model):
@@ -115,11 +115,39 @@ def masses_view():
                                             {"label": "SV", "value": "SV"},
                                             {"label": "UNEDF0", "value": "UNEDF0"},
                                             {"label": "UNEDF1", "value": "UNEDF1"},
+                                            {"label": "Model Mean", "value": "MEAN"},
+                                            {"label": "Model Std. Deviation", "value": "STD"},
+                                            {"label": "Model Spread (Max-Min)", "value": "SPREAD"},
+                                            {"label": "Model Closest to Experiment", "value": "CLOSEST"},
+                                            {"label": "All Models (chains)", "value": "ALL"},
                                         ],
                                         clearable=False,
                                         searchable=False,
                                         value="EXP",
                                     ),
+                                    drc.NamedDropdown(
+                                        name="Compare With (chains)",
+                                        id="dropdown-compare",
+                                        options=[
+                                            {"label": "Experiment", "value": "EXP"},
+                                            {"label": "ME2", "value": "ME2"},
+                                            {"label": "MEdelta", "value": "MEdelta"},
+                                            {"label": "PC1", "value": "PC1"},
+                                            {"label": "NL3S", "value": "NL3S"},
+                                            {"label": "SkMs", "value": "SKMS"},
+                                            {"label": "SKP", "value": "SKP"},
+                                            {"label": "SLY4", "value": "SLY4"},
+                                            {"label": "SV", "value": "SV"},
+                                            {"label": "UNEDF0", "value": "UNEDF0"},
+                                            {"label": "UNEDF1", "value": "UNEDF1"},
+                                            {"label": "Model Mean", "value": "MEAN"},
+                                            {"label": "Model Closest to Experiment", "value": "CLOSEST"},
+                                        ],
+                                        multi=True,
+                                        searchable=False,
+                                        placeholder="Overlay models",
+                                        value=[],
+                                    ),
                                 ]),
                                 # drc.Card(id="link-card", children=[
                                 #     drc.NamedRadioItems(
@@ -182,6 +210,17 @@ def masses_view():
                                             searchable=False,
                                             value="linear",
                                         ),
+                                        drc.NamedDropdown(
+                                            name="Nuclei",
+                                            id="dropdown-nuclei",
+                                            options=[
+                                                {"label": "Even-Even", "value": "even"},
+                                                {"label": "All Nuclei", "value": "all"},
+                                            ],
+                                            clearable=False,
+                                            searchable=False,
+                                            value="even",
+                                        ),
                                     ]
                                 ),
                                 drc.Card(
@@ -317,20 +356,20 @@ def gpe_view():
                                         id="dropdown-select-quantity",
                                         options=[
                                             #{"label": "All", "value": "All"},
-                                            #{"label": "Binding Energy", "value": "BE"},
-                                            #{"label": "One Neutron Separation Energy", "value": "OneNSE",},
-                                            #{"label": "One Proton Separation Energy", "value": "OnePSE",},
+                                            {"label": "Binding Energy", "value": "BE"},
+                                            {"label": "One Neutron Separation Energy", "value": "OneNSE",},
+                                            {"label": "One Proton Separation Energy", "value": "OnePSE",},
                                             {"label": "Two Neutron Separation Energy", "value": "TwoNSE",},
-                                            #{"label": "Two Proton Separation Energy", "value": "TwoPSE",},
-                                            #{"label": "Alpha Separation Energy", "value": "AlphaSE",},
-                                            #{"label": "Two Proton Shell Gap", "value": "TwoNSGap",},
-                                            #{"label": "Two Neutron Shell Gap", "value": "TwoPSGap",},
-                                            #{"label": "Double Mass Difference", "value": "DoubleMDiff",},
-                                            #{"label": "Neutron 3-Point Odd-Even Binding Energy Difference", "value": "N3PointOED",},
-                                            #{"label": "Proton 3-Point Odd-Even Binding Energy Difference", "value": "P3PointOED",},
-                                            #{"label": "Single-Neutron Energy Splitting", "value": "SNESplitting",},
-                                            #{"label": "Single-Proton Energy Splitting", "value": "SPESplitting",},
-                                            #{"label": "Wigner Energy Coefficient", "value": "WignerEC",},
+                                            {"label": "Two Proton Separation Energy", "value": "TwoPSE",},
+                                            {"label": "Alpha Separation Energy", "value": "AlphaSE",},
+                                            {"label": "Two Proton Shell Gap", "value": "TwoNSGap",},
+                                            {"label": "Two Neutron Shell Gap", "value": "TwoPSGap",},
+                                            {"label": "Double Mass Difference", "value": "DoubleMDiff",},
+                                            {"label": "Neutron 3-Point Odd-Even Binding Energy Difference", "value": "N3PointOED",},
+                                            {"label": "Proton 3-Point Odd-Even Binding Energy Difference", "value": "P3PointOED",},
+                                            {"label": "Single-Neutron Energy Splitting", "value": "SNESplitting",},
+                                            {"label": "Single-Proton Energy Splitting", "value": "SPESplitting",},
+                                            {"label": "Wigner Energy Coefficient", "value": "WignerEC",},
                                         ],
                                         clearable=False,
                                         searchable=False,
@@ -346,7 +385,17 @@ def gpe_view():
                                         id="dropdown-select-dataset",
                                         options=[
                                             {"label": "FRDM", "value": "FRDM"},
-                                            #{"label": "SkMs", "value": "SkMs"},
+                                            {"label": "ME2", "value": "ME2"},
+                                            {"label": "MEdelta", "value": "MEdelta"},
+                                            {"label": "PC1", "value": "PC1"},
+                                            {"label": "NL3S", "value": "NL3S"},
+                                            {"label": "SkMs", "value": "SKMS"},
+                                            {"label": "SKP", "value": "SKP"},
+                                            {"label": "SLY4", "value": "SLY4"},
+                                            {"label": "SV", "value": "SV"},
+                                            {"label": "UNEDF0", "value": "UNEDF0"},
+                                            {"label": "UNEDF1", "value": "UNEDF1"},
+                                            {"label": "Model Mean", "value": "MEAN"},
                                         ],
                                         clearable=False,
                                         searchable=False,
@@ -390,7 +439,32 @@ def gpe_view():
                                         style={'width':'100%'},
                                         value=0.2533,
                                     ),
+                                    drc.NamedDropdown(
+                                        name="GP Method",
+                                        id="dropdown-gp-method",
+                                        options=[
+                                            {"label": "Exact", "value": "exact"},
+                                            {"label": "Sparse (inducing nuclei)", "value": "sparse"},
+                                            {"label": "Kronecker (N x Z lattice)", "value": "kronecker"},
+                                        ],
+                                        clearable=False,
+                                        searchable=False,
+                                        value="exact",
+                                    ),
+                                    drc.NamedInput(
+                                        name="Inducing Nuclei",
+                                        id="inducing",
+                                        type="number",
+                                        min=10,
+                                        max=2000,
+                                        step=1,
+                                        placeholder="Inducing Nuclei",
+                                        style={'width':'100%'},
+                                        value=200,
+                                    ),
                                     html.Button('Train!', id='submit-gpe', n_clicks=0, style={"color":"#e76f51"}),
+                                    html.Button('Optimize', id='optimize-gpe', n_clicks=0, style={"color":"#e76f51"}),
+                                    html.Div(id='optimize-gpe-output'),
                                 ]
                             ),
                             drc.Card(
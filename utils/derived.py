@@ -0,0 +1,71 @@
+import numpy as np
+
+# Derived mass quantities computed from a binding energy grid with array
+# shifts, one pass per model. Grids are indexed [Z, N] and hold the stored
+# (negative) binding energies; every derived grid is returned in the same
+# stored sign convention that bmex.QuanValue flips. A missing neighbour is NaN
+# and propagates, so a value only exists where its whole stencil does.
+
+# Binding energy of the alpha particle (MeV)
+alpha_BE = 28.295674
+
+derived_quantities = ['OneNSE', 'OnePSE', 'TwoNSE', 'TwoPSE', 'AlphaSE', 'TwoNSGap', 'TwoPSGap', 'DoubleMDiff',
+    'N3PointOED', 'P3PointOED', 'SNESplitting', 'SPESplitting', 'WignerEC']
+
+# out[Z, N] = a[Z+dz, N+dn], NaN where that nucleus is off the grid
+def shift(a, dz, dn):
+    out = np.full(a.shape, np.nan)
+    nz, nn = a.shape
+    out[max(0,-dz):min(nz,nz-dz), max(0,-dn):min(nn,nn-dn)] = a[max(0,dz):min(nz,nz+dz), max(0,dn):min(nn,nn+dn)]
+    return out
+
+# given maps separation energies to grids (stored sign) that take precedence
+# over the ones formed from BE, e.g. a model sheet's S_n for an even-even
+# table that has no odd neighbours to difference. The quantities built on the
+# separation energies use the combined values.
+def derive(BE, given=None):
+    B = -np.asarray(BE, dtype=float)
+    Z, N = np.indices(B.shape)
+    signN = np.where(N%2==0, 1.0, -1.0)
+    signZ = np.where(Z%2==0, 1.0, -1.0)
+    given = given or {}
+
+    def separation(name, value):
+        if name in given:
+            return np.where(np.isnan(given[name]), value, -np.asarray(given[name], dtype=float))
+        return value
+
+    q = {}
+    q['OneNSE'] = separation('OneNSE', B - shift(B,0,-1))
+    q['OnePSE'] = separation('OnePSE', B - shift(B,-1,0))
+    q['TwoNSE'] = separation('TwoNSE', B - shift(B,0,-2))
+    q['TwoPSE'] = separation('TwoPSE', B - shift(B,-2,0))
+    q['AlphaSE'] = separation('AlphaSE', B - shift(B,-2,-2) - alpha_BE)
+    q['TwoNSGap'] = q['TwoNSE'] - shift(q['TwoNSE'],0,2)
+    q['TwoPSGap'] = q['TwoPSE'] - shift(q['TwoPSE'],2,0)
+    # Same stencils as the binding energy differences, written with the
+    # separation energies so given values are used
+    q['DoubleMDiff'] = 0.25*(q['TwoNSE'] - shift(q['TwoNSE'],-2,0))
+    q['N3PointOED'] = 0.5*signN*(q['OneNSE'] - shift(q['OneNSE'],0,1))
+    q['P3PointOED'] = 0.5*signZ*(q['OnePSE'] - shift(q['OnePSE'],1,0))
+    q['SNESplitting'] = signN*(q['OneNSE'] - shift(q['OneNSE'],0,2))
+    q['SPESplitting'] = signZ*(q['OnePSE'] - shift(q['OnePSE'],2,0))
+    # Excess of the double mass difference over its isobaric neighbours,
+    # which peaks along N=Z where the Wigner energy acts
+    q['WignerEC'] = q['DoubleMDiff'] - 0.5*(shift(q['DoubleMDiff'],-2,2) + shift(q['DoubleMDiff'],2,-2))
+    return {k: -v for k, v in q.items()}
+
+separation_quantities = ['OneNSE', 'OnePSE', 'TwoNSE', 'TwoPSE', 'AlphaSE']
+
+# Copy of a (quantity, Z, N) grid with every derived quantity recomputed
+# from its binding energy row, qinput gives the order of the first axis.
+# With keep=True the values already in the grid win and only the missing
+# ones are derived, starting from the grid's separation energies.
+def derive_grid(grid, qinput, keep=False):
+    out = np.array(grid, dtype=float)
+    given = {k: out[qinput.index(k)] for k in separation_quantities if k in qinput} if keep else None
+    for k, v in derive(out[qinput.index('BE')], given).items():
+        if k in qinput:
+            j = qinput.index(k)
+            out[j] = np.where(np.isnan(out[j]), v, out[j]) if keep else v
+    return out
@@ -0,0 +1,13 @@
+import base64
+
+import numpy as np
+
+# Plotly typed-array spec: the array is sent as base64 float32 bytes instead of
+# a JSON list of numbers, NaN marks the gaps (plotly.js >= 2.28). Kept free of
+# heavy imports so utils/gpe.py can use it without loading utils/figures.py
+def typed_array(a, dtype='f4'):
+    a = np.ascontiguousarray(a, dtype=dtype)
+    spec = {'dtype': dtype, 'bdata': base64.b64encode(a.tobytes()).decode('ascii')}
+    if a.ndim > 1:
+        spec['shape'] = ', '.join(str(n) for n in a.shape)
+    return spec
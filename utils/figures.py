@@ -1,8 +1,14 @@
+import json
+import os
+import threading
+from collections import OrderedDict
 import colorlover as cl
 import plotly.graph_objs as go
 import plotly.express as px
 import numpy as np
 import utils.bmex as bmex
+import utils.store as store
+from utils.encoding import typed_array
 from sklearn import metrics
 from pickle import dump, load
 import tensorflow as tf
@@ -15,14 +21,13 @@ def single(quantity, model, Z, N, wigner=0):
     if quantity == 'All':
         # return html.P("All")
         output = []
-        for qs in bmex.qinput:
-            result = bmex.QuanValue(N,Z,model,qs,w=0)
-            try:
-                result+"a"
-            except:
-                output.append(html.P(bmex.OutputString(qs)+": "+str(result)+" MeV"))
+        values, valid = bmex.QuanRecord(N,Z,model,w=0)
+        for j in range(len(bmex.qinput)):
+            qs = bmex.qinput[j]
+            if valid[j]:
+                output.append(html.P(bmex.OutputString(qs)+": "+str(values[j])+" MeV"+closest_source(N,Z,model,qs)))
             else:
-                output.append(html.P(result))
+                output.append(html.P("Error: "+str(model)+" data does not have "+bmex.OutputString(qs)+" available for Nuclei with N="+str(N)+" and Z="+str(Z)))
         return html.Div(id="nucleiAll", children=output, style={'font-size':'3rem'})
     # all_eval = []
     #         for name, val in  bmex.__dict__.items():
@@ -38,22 +43,82 @@ def single(quantity, model, Z, N, wigner=0):
         try:
             result+"a"
         except:
-            return html.P(model+" "+bmex.OutputString(quantity)+": "+str(result)+" MeV")
+            return html.P(model+" "+bmex.OutputString(quantity)+": "+str(result)+" MeV"+closest_source(N,Z,model,quantity))
         return html.P(result)
 
+# Which theory model a CLOSEST value was taken from
+def closest_source(N, Z, model, quantity):
+    if model != 'CLOSEST':
+        return ""
+    source = bmex.ClosestModel(N,Z,quantity)
+    return " (from "+source+")" if source else ""
+
+# A chain can overlay several models: a list of model names, or 'ALL' for
+# every model in bmex.modelNames
+def chain_models(model):
+    if isinstance(model, (list, tuple)):
+        return list(model)
+    if model == 'ALL':
+        return list(bmex.modelNames)
+    return [model]
+
+# The dataset together with the models picked to compare against it, a
+# single name when there is nothing to overlay
+def chain_selection(dataset, compare=None):
+    models = []
+    for m in chain_models(dataset)+list(compare or []):
+        if m not in models:
+            models.append(m)
+    return models if len(models) > 1 else dataset
+
+def chain_title(model):
+    if model == 'ALL':
+        return "All Models"
+    if isinstance(model, (list, tuple)):
+        return ", ".join(model)
+    return str(model)
+
+# Union of the populated extents of the chain over models, (0, -1) if empty
+def chain_extent(extents):
+    extents = [e for e in extents if e is not None]
+    if not extents:
+        return (0, -1)
+    return (min(e[0] for e in extents), max(e[1] for e in extents))
+
+# One trace per model, each filled by a single batched lookup along the chain
+def chain_traces(models, x, lookup):
+    traces = []
+    for m in models:
+        output, valid = lookup(m)
+        if len(models) == 1:
+            trace = go.Scatter(
+                x=x[valid], y=output[valid], mode="lines+markers", name="Test Data", marker=\
+                    {
+                        "color": "#13c6e9",
+                        #"size": 20,
+                    }
+            )
+        else:
+            trace = go.Scatter(x=x[valid], y=output[valid], mode="lines+markers", name=m)
+        traces.append(trace)
+    return traces
+
 def isotopic(quantity, model, colorbar, wigner, ZRange, NRange):
     Z = ZRange['protons']
     Nmin = NRange['nmin']
     Nmax = NRange['nmax']
+    models = chain_models(model)
 
-    if(Nmin == None):
-        Nmin = 0
-    if(Nmax == None):
-        Nmax = 156
+    # Only walk the populated part of the chain
+    extent = chain_extent([bmex.NExtent(Z,m,quantity) for m in models])
+    if(Nmin == None or Nmin < extent[0]):
+        Nmin = extent[0]
+    if(Nmax == None or Nmax > extent[1]):
+        Nmax = extent[1]
 
     layout = go.Layout(
         #title=f"ROC Curve (AUC = {auc_score:.3f})",
-        title=f"Isotopic Chain"+"  -  "+str(model)+"  -  Z = "+str(Z),
+        title=f"Isotopic Chain"+"  -  "+chain_title(model)+"  -  Z = "+str(Z),
         xaxis=dict(title="Neutrons", gridcolor="#2f3445",title_font_size=14),
         yaxis=dict(title=bmex.OutputString(quantity), gridcolor="#2f3445",title_font_size=14),
         #legend=dict(x=0, y=1.05, orientation="h"),
@@ -63,28 +128,10 @@ def isotopic(quantity, model, colorbar, wigner, ZRange, NRange):
         font={"color": "#a5b1cd", "size": 14},
     )
 
-    neutrons = []
-    output = []
-    for N in list(range(Nmin,Nmax+1)):
-        q = bmex.QuanValue(N,Z,model,quantity,wigner)
-        try: 
-            q+1
-        except:
-            continue
-        else:
-            neutrons.append(N)
-            output.append(q)
-
-    trace0 = go.Scatter(
-        x=neutrons, y=output, mode="lines+markers", name="Test Data", marker=\
-            {
-                "color": "#13c6e9",
-                #"size": 20,
-            }
-    )
+    neutrons = np.arange(Nmin,Nmax+1)
+    data = chain_traces(models, neutrons, lambda m: bmex.QuanArray(neutrons,Z,m,quantity,wigner))
 
     #figure = px.line(x=Z, y=output, markers=True)
-    data = [trace0]
     figure = go.Figure(data=data, layout=layout)
     figure.update_xaxes(title_font_size=20)
     figure.update_yaxes(title_font_size=20)
@@ -95,15 +142,18 @@ def isotonic(quantity, model, colorbar, wigner, ZRange, NRange):
     N = NRange['neutrons']
     Zmin = ZRange['zmin']
     Zmax = ZRange['zmax']
-
-    if(Zmin == None):
-        Zmin = 0
-    if(Zmax == None):
-        Zmax = 106
+    models = chain_models(model)
+
+    # Only walk the populated part of the chain
+    extent = chain_extent([bmex.ZExtent(N,m,quantity) for m in models])
+    if(Zmin == None or Zmin < extent[0]):
+        Zmin = extent[0]
+    if(Zmax == None or Zmax > extent[1]):
+        Zmax = extent[1]
         
     layout = go.Layout(
         #title=f"ROC Curve (AUC = {auc_score:.3f})",
-        title=f"Isotonic Chain"+"  -  "+str(model)+"  -  N = "+str(N),
+        title=f"Isotonic Chain"+"  -  "+chain_title(model)+"  -  N = "+str(N),
         xaxis=dict(title="Protons", gridcolor="#2f3445", title_font_size=14),
         yaxis=dict(title=bmex.OutputString(quantity), gridcolor="#2f3445",title_font_size=14),
         #legend=dict(x=0, y=1.05, orientation="h"),
@@ -113,42 +163,32 @@ def isotonic(quantity, model, colorbar, wigner, ZRange, NRange):
         font={"color": "#a5b1cd", "size": 14},
     )
 
-    protons = []
-    output = []
-    for Z in list(range(Zmin,Zmax+1)):
-        q = bmex.QuanValue(N,Z,model,quantity,wigner)
-        try: 
-            q+1
-        except:
-            continue
-        else:
-            protons.append(Z)
-            output.append(q)
-
-    trace0 = go.Scatter(
-        x=protons, y=output, mode="lines+markers", name="Test Data", marker=\
-            {
-                "color": "#13c6e9",
-                #"size": 20,
-            }
-    )
+    protons = np.arange(Zmin,Zmax+1)
+    data = chain_traces(models, protons, lambda m: bmex.QuanArray(N,protons,m,quantity,wigner))
 
     #figure = px.line(x=Z, y=output, markers=True)
-    data = [trace0]
     figure = go.Figure(data=data, layout=layout)
     figure.update_xaxes(title_font_size=20)
     figure.update_yaxes(title_font_size=20)
     figure.update_layout(title_font_size=24)
     return figure
 
-def landscape(quantity, model, colorbar, wigner, ZRange=None, NRange=None):
-    layout = go.Layout(
+# Axis ranges of the landscape overview
+landscape_nrange = [0, bmex.chart_nmax]
+landscape_zrange = [0, bmex.chart_zmax]
+
+def landscape_layout(quantity, model, xrange=None, yrange=None):
+    if xrange is None:
+        xrange = landscape_nrange
+    if yrange is None:
+        yrange = landscape_zrange
+    return go.Layout(
             font={"color": "#a5b1cd"},
             title=dict(text=bmex.OutputString(quantity)+"   -   "+str(model), font=dict(size=20)),
             xaxis=dict(title=dict(text="Neutrons", font=dict(size=20)), gridcolor="#646464", tick0=0, dtick=25, showline=True, #gridcolor="#2f3445",
-            showgrid=True, gridwidth=1, minor=dict(tick0=0, dtick=5, showgrid=True, gridcolor="#3C3C3C",), mirror='ticks', zeroline=False, range=[0,156]),
+            showgrid=True, gridwidth=1, minor=dict(tick0=0, dtick=5, showgrid=True, gridcolor="#3C3C3C",), mirror='ticks', zeroline=False, range=xrange),
             yaxis=dict(title=dict(text="Protons", font=dict(size=20)), gridcolor="#646464", tick0=0, dtick=25, showline=True,
-            showgrid=True, gridwidth=1, minor=dict(tick0=0, dtick=5, showgrid=True, gridcolor="#3C3C3C",), mirror='ticks', zeroline=False, range=[0,104]),
+            showgrid=True, gridwidth=1, minor=dict(tick0=0, dtick=5, showgrid=True, gridcolor="#3C3C3C",), mirror='ticks', zeroline=False, range=yrange),
             #legend=dict(x=0, y=1.05, orientation="h"),
             #margin=dict(l=100, r=10, t=25, b=40),
             plot_bgcolor="#282b38",
@@ -158,59 +198,55 @@ def landscape(quantity, model, colorbar, wigner, ZRange=None, NRange=None):
             height=440,
     )
 
-    step = 2
-
-    values = np.full((200//step,350//step), None)
-    for Z in range(2, 105, step):
-        chain = bmex.IsotopicChain(Z, model, quantity, step, wigner)
-        for N in chain["N"]:
-            values[Z//2,N//2] = chain[chain["N"]==N].iloc[0,0]
-    
-    filtered = []
-    for e in values.flatten():
-        try:
-            e + 0.0
-        except:
-            pass
-        else:
-            filtered.append(e)
-    filtered = np.array(filtered)
-    max_z=float(np.percentile(filtered, [97]))
-    equalized_color = filtered[filtered>=0]
-    equalized_color = equalized_color[equalized_color<=max_z]
-    
-    def cb(colorbar):
-        if(colorbar == 'linear'):
-            return [
-            [0, 'rgb(0, 0, 0)'],
-            [.01, 'rgb(127, 0, 255)'],
-            [.2, 'rgb(0, 0, 255)'],      
-            [.39, 'rgb(0, 255, 127)'],
-            [.58, 'rgb(127, 255, 0)'],
-            [.76, 'rgb(255, 255, 0)'],
-            [.95, 'rgb(255, 128, 0)'],
-            [1, 'rgb(255, 0, 0)'],
-            ]
-        elif(colorbar == 'equal'):
-            range_z = max(equalized_color) - min(equalized_color)
-            scale = (np.percentile(equalized_color, [19*x for x in range(1,6)]))/range_z
-            return [
-            [0, 'rgb(0, 0, 0)'],
-            [.01, 'rgb(127, 0, 255)'],
-            [scale[0], 'rgb(0, 0, 255)'],      
-            [scale[1], 'rgb(0, 255, 127)'],
-            [scale[2], 'rgb(127, 255, 0)'],
-            [scale[3], 'rgb(255, 255, 0)'],
-            [scale[4], 'rgb(255, 128, 0)'],
-            [1, 'rgb(255, 0, 0)'],
-            ]
-        elif(colorbar == 'monochrome'):
-            return  [[0, 'rgb(230, 120, 85)'], [1, 'rgb(255, 255, 255)']]
-
-    trace = go.Heatmap(
-                x=np.arange(2,155,step), y=np.arange(2,105,step), z=values, 
-                zmin=0, zmax=max_z, name = "",
-                colorscale=cb(colorbar),
+# Percentiles placed on the inner stops of the 'equal' colorbar, any number
+equal_levels = [19, 38, 57, 76, 95]
+
+# Colors the inner stops of the 'equal' colorbar run through, interpolated
+# when there are more or fewer stops than colors
+equal_colors = [(0, 0, 255), (0, 255, 127), (127, 255, 0), (255, 255, 0), (255, 128, 0)]
+
+def equal_palette(count):
+    positions = np.linspace(0, len(equal_colors)-1, count) if count > 1 else [0]
+    palette = []
+    for p in positions:
+        i = min(int(p), len(equal_colors)-2)
+        t = p-i
+        rgb = [int(round(a+(b-a)*t)) for a, b in zip(equal_colors[i], equal_colors[i+1])]
+        palette.append('rgb({}, {}, {})'.format(*rgb))
+    return palette
+
+# stops are the inner color positions of the 'equal' colorbar
+def landscape_colorscale(colorbar, stops=None):
+    if(colorbar == 'linear'):
+        return [
+        [0, 'rgb(0, 0, 0)'],
+        [.01, 'rgb(127, 0, 255)'],
+        [.2, 'rgb(0, 0, 255)'],      
+        [.39, 'rgb(0, 255, 127)'],
+        [.58, 'rgb(127, 255, 0)'],
+        [.76, 'rgb(255, 255, 0)'],
+        [.95, 'rgb(255, 128, 0)'],
+        [1, 'rgb(255, 0, 0)'],
+        ]
+    elif(colorbar == 'equal'):
+        scale = [float(x) for x in stops]
+        return ([[0, 'rgb(0, 0, 0)'], [.01, 'rgb(127, 0, 255)']] +
+            [[s, c] for s, c in zip(scale, equal_palette(len(scale)))] +
+            [[1, 'rgb(255, 0, 0)']])
+    elif(colorbar == 'monochrome'):
+        return  [[0, 'rgb(230, 120, 85)'], [1, 'rgb(255, 255, 255)']]
+
+# sources names the model behind every value (the CLOSEST dataset), shown on hover
+def landscape_trace(neutrons, protons, values, max_z, colorscale, min_z=0, sources=None):
+    hover = ('<b><i>N</i></b>: %{x}<br>'+
+            '<b><i>Z</i></b>: %{y}<br>'+
+            '<b><i>Value</i></b>: %{z}')
+    if sources is not None:
+        hover += '<br><b><i>Model</i></b>: %{text}'
+    return go.Heatmap(
+                x=neutrons, y=protons, z=typed_array(values), text=sources,
+                zmin=float(min_z), zmax=float(max_z), name = "",
+                colorscale=colorscale,
                 colorbar=dict(
                     title="",
                     #len=,
@@ -220,12 +256,112 @@ def landscape(quantity, model, colorbar, wigner, ZRange=None, NRange=None):
                     # tickvals= [-2, 0, 2, 4, 6],
                     # ticktext= ["<0", "0", "2", "4", "6"],
                 ),
-                hovertemplate = '<b><i>N</i></b>: %{x}<br>'+
-                        '<b><i>Z</i></b>: %{y}<br>'+
-                        '<b><i>Value</i></b>: %{z}',          
+                hovertemplate = hover,
     )
-    
-    return go.Figure(data=[trace], layout=layout)
+
+def landscape_sources(model, quantity, protons, neutrons):
+    if model != 'CLOSEST':
+        return None
+    return bmex.ClosestModels(protons, neutrons, quantity)
+
+def landscape(quantity, model, colorbar, wigner, ZRange=None, NRange=None, nuclei='even'):
+    # Even-even nuclei only unless the full chart (odd-A and odd-odd) is asked for
+    step = 1 if nuclei == 'all' else 2
+
+    protons, neutrons, values = bmex.QuanGrid(model, quantity, wigner, step)
+    max_z = bmex.Percentile(model, quantity, 97, wigner, step)
+    if np.isnan(max_z):
+        max_z = 0.0
+    stops = None
+    if colorbar == 'equal':
+        stops = bmex.EqualizedStops(model, quantity, max_z, equal_levels, wigner, step)
+
+    trace = landscape_trace(neutrons, protons, values, max_z, landscape_colorscale(colorbar, stops),
+        sources=landscape_sources(model, quantity, protons, neutrons))
+    return go.Figure(data=[trace], layout=landscape_layout(quantity, model))
+
+# Full-resolution landscape of the window [nmin, nmax] x [zmin, zmax] with the
+# colorscale fitted to the nuclei inside it, served when a user zooms in
+def landscape_window(quantity, model, colorbar, wigner, nmin, nmax, zmin, zmax):
+    protons, neutrons, values = bmex.QuanGrid(model, quantity, wigner, 1)
+    rows = (protons >= np.floor(zmin)) & (protons <= np.ceil(zmax))
+    cols = (neutrons >= np.floor(nmin)) & (neutrons <= np.ceil(nmax))
+    protons, neutrons, values = protons[rows], neutrons[cols], values[rows][:, cols]
+
+    filtered = values[~np.isnan(values)]
+    if len(filtered) == 0:
+        filtered = np.zeros(1)
+    # Stretch the colorscale over the window, keeping black for values <= 0
+    # when the window has any
+    min_z = 0.0 if min(filtered) <= 0 else float(min(filtered))
+    max_z = max(np.percentile(filtered, 97), min_z+1e-6)
+    stops = None
+    if colorbar == 'equal':
+        equalized_color = filtered[(filtered >= min_z) & (filtered <= max_z)]
+        if len(equalized_color) > 1:
+            stops = np.clip((np.percentile(equalized_color, equal_levels) - min_z)/(max_z - min_z), .01, 1)
+        else:
+            stops = np.asarray(equal_levels)/100.0
+
+    trace = landscape_trace(neutrons, protons, values, max_z, landscape_colorscale(colorbar, stops), min_z,
+        landscape_sources(model, quantity, protons, neutrons))
+    return go.Figure(data=[trace], layout=landscape_layout(quantity, model, [nmin, nmax], [zmin, zmax]))
+
+# Landscape figures only depend on (quantity, model, colorbar, wigner, nuclei),
+# so they are kept as plotly JSON dicts in a bounded in-memory LRU backed by
+# utils/store/cache/landscape, which every worker shares. Returned dicts are
+# shared between callers and must not be modified.
+landscape_cache = OrderedDict()
+landscape_cache_size = int(os.environ.get("BMEX_FIGURE_CACHE_SIZE", 128))
+landscape_lock = threading.Lock()
+
+# Part of the cache version so a change in how figures are encoded drops
+# the stale disk entries
+landscape_format = 'f4.3'
+
+def landscape_key(quantity, model, colorbar, wigner, nuclei='even'):
+    return "-".join([str(model), str(quantity), str(colorbar), str(wigner), str(nuclei)])
+
+def landscape_json(quantity, model, colorbar, wigner, ZRange=None, NRange=None, nuclei='even'):
+    key = landscape_key(quantity, model, colorbar, wigner, nuclei)
+    version = bmex.data_version()+'-'+landscape_format
+    with landscape_lock:
+        if (version, key) in landscape_cache:
+            landscape_cache.move_to_end((version, key))
+            return landscape_cache[(version, key)]
+    text = store.load_json('landscape', key, version)
+    if text is None:
+        text = landscape(quantity, model, colorbar, wigner, nuclei=nuclei).to_json()
+        # The grids reload themselves on a data change; a figure built while
+        # the store was being rewritten is returned but never cached
+        if bmex.data_version()+'-'+landscape_format != version:
+            return json.loads(text)
+        try:
+            store.write_json('landscape', key, version, text)
+        except OSError:
+            pass
+    fig = json.loads(text)
+    with landscape_lock:
+        for stale in [k for k in landscape_cache if k[0] != version]:
+            del landscape_cache[stale]
+        landscape_cache[(version, key)] = fig
+        while len(landscape_cache) > landscape_cache_size:
+            landscape_cache.popitem(last=False)
+    return fig
+
+# Landscapes a new tab is likely to open: every quantity of the experimental
+# data and every dataset's binding energy, default colorbar
+def default_landscapes():
+    keys = [(q, 'EXP') for q in bmex.qinput] + [('BE', m) for m in bmex.grids if m != 'EXP']
+    return [(q, m, 'linear', 0, 'even') for q, m in keys]
+
+def all_landscapes():
+    return [(q, m, c, w, nuc) for m in bmex.grids for q in bmex.qinput
+        for c in ['linear', 'equal', 'monochrome'] for w in [0, 1, 2] for nuc in ['even', 'all']]
+
+def warm_landscape_cache(combos=None):
+    for quantity, model, colorbar, wigner, nuclei in (combos or default_landscapes()):
+        landscape_json(quantity, model, colorbar, wigner, nuclei=nuclei)
 
 def serve_prediction_plot(
     model, X_train, X_test, y_train, y_test, Z, xx, yy, mesh_step, threshold
@@ -410,7 +546,7 @@ def pesnet_surface(N, Z):
 
     fig = go.Figure(data =
     go.Contour(
-        z=pes,
+        z=typed_array(pes),
         x=Q20, # horizontal axis
         y=Q30, # vertical axis
         colorscale="Spectral_r",
@@ -458,7 +594,7 @@ def true_surface(df, N, Z):
 
     fig = go.Figure(data =
     go.Contour(
-        z=np.reshape(E.to_numpy(),(q20num,q30num)).T,
+        z=typed_array(np.reshape(E.to_numpy(),(q20num,q30num)).T),
         x=Q20, # horizontal axis
         y=Q30, # vertical axis
         colorscale="Spectral_r",
@@ -584,3 +720,8 @@ def serve_pie_confusion_matrix(model, X_test, y_test, Z, threshold):
     figure = go.Figure(data=data, layout=layout)
 
     return figure
+
+if __name__ == "__main__":
+    # python -m utils.figures [--all] writes the landscape cache to utils/store
+    import sys
+    warm_landscape_cache(all_landscapes() if '--all' in sys.argv else None)
@@ -2,17 +2,66 @@ import numpy as np
 from numpy.lib.index_tricks import fill_diagonal
 import plotly.graph_objs as go
 import pandas as pd
+import hashlib
+import os
+import threading
 import time
+from collections import OrderedDict
+from scipy import linalg, optimize, spatial
+from scipy.sparse import linalg as sparse_linalg
 
-Data=np.loadtxt("utils/TwoNSEDeltaFRDM2003.txt")
+import utils.bmex as bmex
+from utils.encoding import typed_array
+import utils.store as store
 
-DataExtrapolar=np.loadtxt("utils/FRDMTwoNSE.txt")
+# The GP text tables, reloaded by load_tables whenever one of their files
+# changes on disk (e.g. new AME rows appended to TwoNSEDeltaFRDM2003).
+# gp_tables_version hashes their contents.
+tables_lock = threading.Lock()
+tables_stamp = None
 
-DataExp=np.loadtxt("utils/TwoNSE2016Full.txt")
+def table_files():
+    return [store.table_path(name) if os.path.exists(store.table_path(name)) else 'utils/'+name+'.txt'
+        for name in store.gpe_tables]
+
+def load_tables():
+    global Data, DataExtrapolar, DataExp, gp_tables_version, tables_stamp
+    stamp = "-".join("{}.{:x}.{:x}".format(f, st.st_mtime_ns, st.st_size)
+        for f, st in [(f, os.stat(f)) for f in table_files()])
+    with tables_lock:
+        if stamp != tables_stamp:
+            Data = store.load_table("TwoNSEDeltaFRDM2003")
+            DataExtrapolar = store.load_table("FRDMTwoNSE")
+            DataExp = store.load_table("TwoNSE2016Full")
+            gp_tables_version = hashlib.sha1(np.ascontiguousarray(Data).tobytes()+np.ascontiguousarray(DataExtrapolar).tobytes()).hexdigest()[:16]
+            tables_stamp = stamp
+
+load_tables()
 
 default_model = [0.9, 1.529, 0.2533]
 
-gp_output = np.load("utils/default_gp.npy")
+# Precomputed default GP, valid for the tables it was trained on
+gp_output = np.load("utils/default_gp.npy", mmap_mode='r')
+gp_output_version = gp_tables_version
+
+# The GP learns the residual EXP - model of one quantity. 'FRDM' is the
+# two-neutron separation energy tables above; any bmex model is read from its
+# grid. Returns the training rows (N, Z, residual) and the rows (N, Z, model
+# value) the GP extrapolates to.
+def gp_tables(dataset='FRDM', quantity='TwoNSE'):
+    if dataset == 'FRDM':
+        if quantity != 'TwoNSE':
+            raise ValueError("FRDM is only available for the Two Neutron Separation Energy")
+        load_tables()
+        return np.asarray(Data), np.asarray(DataExtrapolar)
+    if dataset not in bmex.grids or dataset == 'EXP' or quantity not in bmex.q_index:
+        raise ValueError("No GP for "+str(dataset)+" "+str(quantity))
+    Z, N = np.nonzero(~np.isnan(bmex.grids[dataset][bmex.q_index[quantity]]))
+    theory = bmex.QuanArray(N,Z,dataset,quantity)[0]
+    exp, measured = bmex.QuanArray(N,Z,'EXP',quantity)
+    X = np.column_stack([N, Z, exp-theory])[measured]
+    Xs = np.column_stack([N, Z, theory])
+    return X.astype(float), Xs.astype(float)
 
 def Ker(X1,X2,model):
     eta = model[0]
@@ -20,81 +69,506 @@ def Ker(X1,X2,model):
     rhoZ = model[2]
     return eta**2*np.exp(-1.0/(2*rhoN**2)*(X1[0]-X2[0])**2-1.0/(2*rhoZ**2)*(X1[1]-X2[1])**2)
 
+# Kernel matrix between the points X1 (n, >=2) and X2 (m, >=2), whose first
+# two columns are N and Z
+def KerMatrix(X1,X2,model=default_model):
+    eta = model[0]
+    rhoN = model[1]
+    rhoZ = model[2]
+    X1 = np.asarray(X1)
+    X2 = np.asarray(X2)
+    dN = X1[:,0,None]-X2[None,:,0]
+    dZ = X1[:,1,None]-X2[None,:,1]
+    return eta**2*np.exp(-1.0/(2*rhoN**2)*dN**2-1.0/(2*rhoZ**2)*dZ**2)
+
+# Single-point mean and band from an explicit inverse, kept for callers of
+# the old interface; GPPredict is the batched path
 def GP_l(x,KXXInv1,Data1,model=default_model):
-    KxX=np.zeros(len(Data1))
-    for i in range(len(Data1)):
-        KxX[i]=Ker(Data1[i],x,model)
-        
-    YmX=np.zeros(len(Data1))
-    for i in range(len(Data1)):
-        YmX[i]=Data1[i][2]
-    return np.dot(KxX,np.dot(KXXInv1,YmX))
+    KxX = KerMatrix([x],Data1,model)[0]
+    return np.dot(KxX,np.dot(KXXInv1,np.asarray(Data1)[:,2]))
 
 def GPBand(x,KXXInv1,Data1,model=default_model):
-    KxX=np.zeros(len(Data1))
-    for i in range(len(Data1)):
-        KxX[i]=Ker(Data1[i],x,model)
-    
+    KxX = KerMatrix([x],Data1,model)[0]
     return np.sqrt(abs(Ker(x,x,model)-np.dot(KxX,np.dot(KXXInv1,KxX))))
 
-def update_GP(model=default_model):
+# Posterior mean and standard deviation at the points Xs given the Cholesky
+# factor L of the training kernel and alpha = KXX^-1 y. Rows are processed
+# chunk at a time so the cross-kernel never exceeds chunk x len(X) floats.
+def GPPredict(Xs,X,L,alpha,model=default_model,chunk=1024):
+    Xs = np.asarray(Xs)
+    mean = np.empty(len(Xs))
+    band = np.empty(len(Xs))
+    for start in range(0, len(Xs), chunk):
+        KxX = KerMatrix(Xs[start:start+chunk],X,model)
+        V = linalg.solve_triangular(L, KxX.T, lower=True, check_finite=False)
+        mean[start:start+chunk] = KxX.dot(alpha)
+        band[start:start+chunk] = np.sqrt(abs(model[0]**2-np.einsum('ij,ij->j', V, V)))
+    return mean, band
+
+# Very smooth kernels make KXX numerically singular; the factorization is
+# then retried with a small diagonal term, scaled by the kernel variance.
+# Returns the lower factor and the diagonal term that was added.
+def cholesky_jitter(K, scale, tries=6):
+    jitter = 0.0
+    for i in range(tries):
+        try:
+            return linalg.cholesky(K+jitter*np.eye(len(K)), lower=True), jitter
+        except linalg.LinAlgError:
+            jitter = scale*10.0**(i-10)
+    return linalg.cholesky(K+jitter*np.eye(len(K)), lower=True), jitter
+
+# A fit is a dict holding the hyperparameters, the training points X (rows of
+# N, Z, value), the Cholesky factor L of KXX + jitter I and alpha = KXX^-1 y
+def fit_GP(model=default_model, X=None):
+    if X is None:
+        X = Data
+    X = np.array(X, dtype=float)
+    L, jitter = cholesky_jitter(KerMatrix(X,X,model), model[0]**2)
+    return {'model': list(model), 'X': X, 'L': L, 'alpha': linalg.cho_solve((L, True), X[:,2]), 'jitter': jitter}
+
+# Columns of results: N, Z, model value, model + GP mean, GP standard deviation.
+# Pass a dict as timings to get the seconds spent in each step. Returns the
+# results with the fit of the training set.
+def train_GP(model=default_model, timings=None, dataset='FRDM', quantity='TwoNSE'):
     t_start = time.time()
 
-    KXX=np.zeros((len(Data),len(Data)))
-
-    for i in range(len(Data)):
-        for j in range(i+1):
-            #print([i,j])
-            KXX[i][j]=Ker(Data[i],Data[j],model)
-            KXX[j][i]=KXX[i][j]
-
-    KXX1= np.linalg.inv(KXX)
-    results = np.zeros((len(DataExtrapolar),5))
-
-    for i in range(len(DataExtrapolar)):
-        results[i] = [DataExtrapolar[i][0],DataExtrapolar[i][1],DataExtrapolar[i][2],DataExtrapolar[i][2]+GP_l(DataExtrapolar[i],KXX1,Data,model),GPBand(DataExtrapolar[i],KXX1,Data,model)]
-    ''' 
-    plotExp=[]
-    plotFRDM=[]
-    plotFRDMGP=[]
-    plotFRDMGPBandplus=[]
-    plotFRDMGPBandminus=[]
-
-    for i in range(len(DataExp)):
-        if DataExp[i][1]==ZPlot:
-            plotExp.append([DataExp[i][0],DataExp[i][2]])
-    plotExp=np.array(plotExp)        
-            
-    for i in range(len(DataExtrapolar)):
-        if DataExtrapolar[i][1]==ZPlot:
-            plotFRDM.append([DataExtrapolar[i][0],DataExtrapolar[i][2]])
-    plotFRDM=np.array(plotFRDM)
-    for i in range(len(results)):
-        if results[i][1]==ZPlot:
-            plotFRDMGP.append([results[i][0],results[i][3]])
-            plotFRDMGPBandplus.append([results[i][0],results[i][3]+results[i][4]])
-            plotFRDMGPBandminus.append([results[i][0],results[i][3]-results[i][4]])
-            
-    plotFRDMGP=np.array(plotFRDMGP)        
-    plotFRDMGPBandplus=np.array(plotFRDMGPBandplus)
-    plotFRDMGPBandminus=np.array(plotFRDMGPBandminus)
-    '''
+    X, Xs = gp_tables(dataset, quantity)
+    KXX = KerMatrix(X,X,model)
+    t_kernel = time.time()
+
+    # KXX = L L^T replaces the explicit inverse
+    L, jitter = cholesky_jitter(KXX, model[0]**2)
+    alpha = linalg.cho_solve((L, True), X[:,2])
+    fit = {'model': list(model), 'X': X, 'L': L, 'alpha': alpha, 'jitter': jitter}
+    t_factor = time.time()
+
+    results = predict_fit(fit, Xs)
+    t_stop = time.time()
+
+    if timings is not None:
+        timings['kernel'] = t_kernel-t_start
+        timings['factor'] = t_factor-t_kernel
+        timings['predict'] = t_stop-t_factor
+        timings['total'] = t_stop-t_start
+    return results, fit
+
+# Rows of N, Z, model value, model + GP mean, GP standard deviation at Xs
+def predict_fit(fit, Xs):
+    Xs = np.asarray(Xs)
+    mean, band = GPPredict(Xs, fit['X'], fit['L'], fit['alpha'], fit['model'])
+    return np.column_stack([Xs[:,0], Xs[:,1], Xs[:,2], Xs[:,2]+mean, band])
+
+# Turns the lower factor L of A into the factor of A + x x^T, in place, O(n^2)
+def cholesky_update(L, x):
+    x = np.array(x, dtype=float)
+    for k in range(len(x)):
+        r = np.hypot(L[k,k], x[k])
+        c = r/L[k,k]
+        sn = x[k]/L[k,k]
+        L[k,k] = r
+        L[k+1:,k] = (L[k+1:,k]+sn*x[k+1:])/c
+        x[k+1:] = c*x[k+1:]-sn*L[k+1:,k]
+    return L
+
+# Fit with the training points Xnew appended. The factor grows by a block
+# row, O(n^2 k) for k new points instead of a refactorization.
+def add_points(fit, Xnew):
+    Xnew = np.atleast_2d(np.array(Xnew, dtype=float))
+    model = fit['model']
+    L = fit['L']
+    n = len(L)
+    B = linalg.solve_triangular(L, KerMatrix(fit['X'],Xnew,model), lower=True)
+    S = KerMatrix(Xnew,Xnew,model)+fit['jitter']*np.eye(len(Xnew))-B.T.dot(B)
+    L22 = cholesky_jitter(S, model[0]**2)[0]
+    Lnew = np.zeros((n+len(Xnew), n+len(Xnew)))
+    Lnew[:n,:n] = L
+    Lnew[n:,:n] = B.T
+    Lnew[n:,n:] = L22
+    X = np.vstack([fit['X'], Xnew])
+    return {'model': model, 'X': X, 'L': Lnew, 'alpha': linalg.cho_solve((Lnew, True), X[:,2]), 'jitter': fit['jitter']}
+
+# Fit without the training points at the row indices idx. Dropping row j
+# leaves a rank-one update of the rows below it, O(n^2) per point.
+def remove_points(fit, idx):
+    L = np.array(fit['L'])
+    X = fit['X']
+    for j in sorted(set(int(i) for i in np.atleast_1d(idx)), reverse=True):
+        tail = np.array(L[j+1:,j+1:])
+        cholesky_update(tail, L[j+1:,j])
+        L = np.delete(np.delete(L, j, axis=0), j, axis=1)
+        L[j:,j:] = tail
+        X = np.delete(X, j, axis=0)
+    return {'model': fit['model'], 'X': X, 'L': L, 'alpha': linalg.cho_solve((L, True), X[:,2]), 'jitter': fit['jitter']}
+
+# Fit for the training set X, reached from fit by removing the rows X no
+# longer has and appending its new ones, e.g. after measurements are added
+# to the training table or a region is excluded
+def refit_GP(fit, X):
+    X = np.array(X, dtype=float)
+    new = set(tuple(row) for row in X)
+    old = set(tuple(row) for row in fit['X'])
+    removed = [i for i in range(len(fit['X'])) if tuple(fit['X'][i]) not in new]
+    added = [row for row in X if tuple(row) not in old]
+    if removed:
+        fit = remove_points(fit, removed)
+    if added:
+        fit = add_points(fit, added)
+    return fit
+
+def update_GP(model=default_model, timings=None, dataset='FRDM', quantity='TwoNSE'):
+    return train_GP(model, timings, dataset, quantity)[0]
+
+# Sparse variational (VFE) approximation on m inducing nuclei spread evenly
+# over the training set: O(n m^2) to train and O(m^2) per predicted nucleus
+# instead of O(n^3) and O(n^2). noise is the residual noise (MeV) that keeps
+# the approximation well posed.
+def inducing_points(X, m):
+    X = np.asarray(X)
+    return X[np.unique(np.linspace(0, len(X)-1, min(m, len(X))).round().astype(int))]
+
+def fit_sparse_GP(model=default_model, X=None, inducing=200, noise=0.1):
+    if X is None:
+        X = Data
+    X = np.array(X, dtype=float)
+    U = inducing_points(X, inducing)
+    Lm = cholesky_jitter(KerMatrix(U,U,model), model[0]**2)[0]
+    A = linalg.solve_triangular(Lm, KerMatrix(U,X,model), lower=True)/noise
+    LB = linalg.cholesky(np.eye(len(U))+A.dot(A.T), lower=True)
+    c = linalg.solve_triangular(LB, A.dot(X[:,2]), lower=True)/noise
+    return {'model': list(model), 'U': U, 'Lm': Lm, 'LB': LB, 'c': c, 'noise': noise}
+
+def predict_sparse(fit, Xs, chunk=1024):
+    Xs = np.asarray(Xs)
+    model = fit['model']
+    mean = np.empty(len(Xs))
+    band = np.empty(len(Xs))
+    for start in range(0, len(Xs), chunk):
+        T1 = linalg.solve_triangular(fit['Lm'], KerMatrix(fit['U'],Xs[start:start+chunk],model), lower=True)
+        T2 = linalg.solve_triangular(fit['LB'], T1, lower=True)
+        mean[start:start+chunk] = T2.T.dot(fit['c'])
+        band[start:start+chunk] = np.sqrt(abs(model[0]**2-np.einsum('ij,ij->j', T1, T1)+np.einsum('ij,ij->j', T2, T2)))
+    return np.column_stack([Xs[:,0], Xs[:,1], Xs[:,2], Xs[:,2]+mean, band])
+
+# Sparse counterpart of train_GP, same results columns and timings
+def train_sparse_GP(model=default_model, timings=None, dataset='FRDM', quantity='TwoNSE', inducing=200, noise=0.1):
+    t_start = time.time()
+    X, Xs = gp_tables(dataset, quantity)
+    fit = fit_sparse_GP(model, X, inducing, noise)
+    t_factor = time.time()
+    results = predict_sparse(fit, Xs)
     t_stop = time.time()
 
-    return results
+    if timings is not None:
+        timings['factor'] = t_factor-t_start
+        timings['predict'] = t_stop-t_factor
+        timings['total'] = t_stop-t_start
+    return results, fit
+
+# Kronecker solver. The kernel factors into an N part and a Z part, so on a
+# lattice of nuclei it is Kz (x) Kn and a kernel product costs two small
+# matrix products. Training nuclei are a masked subset of the lattice spanned
+# by their N and Z (with the common spacing of their coordinates, e.g. 2 for
+# even-even tables); alpha = (KXX + noise^2 I)^-1 y is found with conjugate
+# gradients, preconditioned by the exact inverse on the full lattice from the
+# eigendecompositions of Kn and Kz. The mean is one more lattice product.
+# The band comes from a local GP on the nearest training nuclei of each
+# point (in units of rhoN, rhoZ), which approximates the exact band.
+def kron_lattice(X):
+    N = np.asarray(X)[:,0].astype(int)
+    Z = np.asarray(X)[:,1].astype(int)
+    step = max(int(np.gcd.reduce(np.concatenate([N-N.min(), Z-Z.min()]))), 1)
+    return N.min(), Z.min(), step, (N-N.min())//step, (Z-Z.min())//step
+
+def fit_kron_GP(model=default_model, X=None, noise=0.1, tol=1e-8, maxiter=5000):
+    if X is None:
+        X = Data
+    X = np.array(X, dtype=float)
+    eta = model[0]
+    rhoN = model[1]
+    rhoZ = model[2]
+    n0, z0, step, cols, rows = kron_lattice(X)
+    n = n0+step*np.arange(cols.max()+1)
+    z = z0+step*np.arange(rows.max()+1)
+    Kn = np.exp(-1.0/(2*rhoN**2)*(n[:,None]-n[None,:])**2)
+    Kz = eta**2*np.exp(-1.0/(2*rhoZ**2)*(z[:,None]-z[None,:])**2)
+    ln, Qn = np.linalg.eigh(Kn)
+    lz, Qz = np.linalg.eigh(Kz)
+    spectrum = np.outer(np.clip(lz, 0, None), np.clip(ln, 0, None))+noise**2
+
+    def lattice(v):
+        G = np.zeros((len(z), len(n)))
+        G[rows,cols] = v
+        return G
+
+    def matvec(v):
+        return Kz.dot(lattice(v)).dot(Kn)[rows,cols]+noise**2*v
+
+    def precondition(v):
+        return Qz.dot(Qz.T.dot(lattice(v)).dot(Qn)/spectrum).dot(Qn.T)[rows,cols]
+
+    iterations = [0]
+    def count(x):
+        iterations[0] += 1
+    A = sparse_linalg.LinearOperator((len(X), len(X)), matvec=matvec)
+    M = sparse_linalg.LinearOperator((len(X), len(X)), matvec=precondition)
+    alpha, info = sparse_linalg.cg(A, X[:,2], rtol=tol, maxiter=maxiter, M=M, callback=count)
+    return {'model': list(model), 'X': X, 'alpha': alpha, 'lattice': lattice(alpha), 'n': n, 'z': z,
+        'noise': noise, 'iterations': iterations[0], 'converged': info == 0}
+
+def predict_kron(fit, Xs, neighbours=32, chunk=1024):
+    Xs = np.asarray(Xs)
+    model = fit['model']
+    eta = model[0]
+    rhoN = model[1]
+    rhoZ = model[2]
+    uN, iN = np.unique(Xs[:,0], return_inverse=True)
+    uZ, iZ = np.unique(Xs[:,1], return_inverse=True)
+    KnX = np.exp(-1.0/(2*rhoN**2)*(fit['n'][:,None]-uN[None,:])**2)
+    KzX = eta**2*np.exp(-1.0/(2*rhoZ**2)*(uZ[:,None]-fit['z'][None,:])**2)
+    mean = KzX.dot(fit['lattice']).dot(KnX)[iZ,iN]
+
+    X = fit['X']
+    k = min(neighbours, len(X))
+    scale = np.array([rhoN, rhoZ])
+    tree = spatial.cKDTree(X[:,:2]/scale)
+    band = np.empty(len(Xs))
+    for start in range(0, len(Xs), chunk):
+        idx = tree.query(Xs[start:start+chunk,:2]/scale, k=k)[1].reshape(-1, k)
+        P = X[idx,:2]
+        d = (P[:,:,None,:]-P[:,None,:,:])/scale
+        Kloc = eta**2*np.exp(-0.5*(d**2).sum(-1))+fit['noise']**2*np.eye(k)
+        ks = eta**2*np.exp(-0.5*(((P-Xs[start:start+chunk,None,:2])/scale)**2).sum(-1))
+        V = np.linalg.solve(np.linalg.cholesky(Kloc), ks[:,:,None])[:,:,0]
+        band[start:start+chunk] = np.sqrt(abs(eta**2-(V**2).sum(1)))
+    return np.column_stack([Xs[:,0], Xs[:,1], Xs[:,2], Xs[:,2]+mean, band])
+
+# Kronecker counterpart of train_GP, same results columns; timings also gets
+# the number of conjugate gradient iterations
+def train_kron_GP(model=default_model, timings=None, dataset='FRDM', quantity='TwoNSE', noise=0.1):
+    t_start = time.time()
+    X, Xs = gp_tables(dataset, quantity)
+    fit = fit_kron_GP(model, X, noise)
+    t_factor = time.time()
+    results = predict_kron(fit, Xs)
+    t_stop = time.time()
+
+    if timings is not None:
+        timings['factor'] = t_factor-t_start
+        timings['predict'] = t_stop-t_factor
+        timings['total'] = t_stop-t_start
+        timings['iterations'] = fit['iterations']
+    return results, fit
+
+# Largest training set the exact GP is run on to check an approximate fit
+exact_limit = int(os.environ.get('BMEX_GP_EXACT_LIMIT', 3000))
+
+# Differences between approximate (sparse or Kronecker) and exact results: RMS
+# and largest difference of the GP mean, RMS difference of the band (MeV)
+def approx_accuracy(approx, exact):
+    dmean = np.asarray(approx)[:,3]-np.asarray(exact)[:,3]
+    dband = np.asarray(approx)[:,4]-np.asarray(exact)[:,4]
+    return {'rms_mean': float(np.sqrt(np.mean(dmean**2))), 'max_mean': float(np.max(abs(dmean))),
+        'rms_band': float(np.sqrt(np.mean(dband**2)))}
+
+# Log marginal likelihood of the training set and its gradient with respect
+# to (log eta, log rhoN, log rhoZ), from one factorization of KXX
+def log_marginal_likelihood(model=default_model, X=None):
+    if X is None:
+        X = np.asarray(Data)
+    eta = model[0]
+    rhoN = model[1]
+    rhoZ = model[2]
+    y = X[:,2]
+    dN2 = (X[:,0,None]-X[None,:,0])**2
+    dZ2 = (X[:,1,None]-X[None,:,1])**2
+    KXX = eta**2*np.exp(-1.0/(2*rhoN**2)*dN2-1.0/(2*rhoZ**2)*dZ2)
+    L = cholesky_jitter(KXX, eta**2)[0]
+    alpha = linalg.cho_solve((L, True), y)
+    lml = -0.5*y.dot(alpha)-np.log(np.diag(L)).sum()-0.5*len(X)*np.log(2*np.pi)
+
+    # dlml/dtheta = 1/2 tr((alpha alpha^T - KXX^-1) dKXX/dtheta)
+    W = np.outer(alpha, alpha)-linalg.cho_solve((L, True), np.eye(len(X)))
+    W *= KXX
+    grad = 0.5*np.array([2*W.sum(), (W*dN2).sum()/rhoN**2, (W*dZ2).sum()/rhoZ**2])
+    return lml, grad
+
+# Hyperparameters maximizing the log marginal likelihood, searched with
+# L-BFGS-B in log space from model. timings gets the total time, the number of
+# likelihood evaluations and the optimum's log likelihood.
+def optimize_GP(model=default_model, bounds=[(0.01, 10.0), (0.05, 20.0), (0.05, 20.0)], timings=None, dataset='FRDM', quantity='TwoNSE'):
+    t_start = time.time()
+    X = gp_tables(dataset, quantity)[0]
+
+    def objective(theta):
+        lml, grad = log_marginal_likelihood(np.exp(theta), X)
+        return -lml, -grad
+
+    start = np.log(np.clip(model, [b[0] for b in bounds], [b[1] for b in bounds]))
+    result = optimize.minimize(objective, start, jac=True, method='L-BFGS-B', bounds=np.log(bounds))
+    t_stop = time.time()
+
+    if timings is not None:
+        timings['total'] = t_stop-t_start
+        timings['evaluations'] = result.nfev
+        timings['lml'] = -result.fun
+    return [float(p) for p in np.exp(result.x)]
+
+# Trained GPs are kept by dataset, quantity and rounded hyperparameters:
+# results and fit in a bounded in-memory LRU, results in utils/store/cache/gp,
+# which every worker shares. The version changes with the GP tables and the
+# bmex grids.
+gp_cache = OrderedDict()
+gp_cache_size = int(os.environ.get('BMEX_GP_CACHE_SIZE', 16))
+gp_lock = threading.Lock()
+
+def gp_version():
+    load_tables()
+    return hashlib.sha1((gp_tables_version+bmex.data_version()).encode()).hexdigest()[:16]
+
+def gp_round(model):
+    return [float('{:.6g}'.format(float(p))) for p in model]
+
+def gp_key(model, dataset='FRDM', quantity='TwoNSE', method='exact', inducing=200):
+    key = "-".join([str(dataset), str(quantity)]+['{:.6g}'.format(p) for p in gp_round(model)])
+    if method == 'sparse':
+        key += "-sparse{}".format(int(inducing))
+    elif method == 'kronecker':
+        key += "-kronecker"
+    return key
+
+gp_methods = ['exact', 'sparse', 'kronecker']
+
+# Raises ValueError unless the arguments name a GP gp_tables can build.
+# Tokens come back from the browser, so this runs before a key or cache path
+# is formed from them.
+def check_GP(model, dataset, quantity, method, inducing):
+    if dataset == 'FRDM':
+        if quantity != 'TwoNSE':
+            raise ValueError("FRDM is only available for the Two Neutron Separation Energy")
+    elif not isinstance(dataset, str) or dataset not in bmex.grids or dataset == 'EXP' or quantity not in bmex.qinput:
+        raise ValueError("No GP for "+str(dataset)+" "+str(quantity))
+    if method not in gp_methods:
+        raise ValueError("Unknown GP method "+str(method))
+    if method == 'sparse' and not (isinstance(inducing, (int, float)) and not isinstance(inducing, bool) and 1 <= inducing < 1e6):
+        raise ValueError("The number of inducing nuclei must be a positive number")
+    if not isinstance(model, (list, tuple)) or len(model) != 3 or not all(
+            isinstance(p, (int, float)) and not isinstance(p, bool) and np.isfinite(p) and p > 0 for p in model):
+        raise ValueError("The GP hyperparameters must be three positive numbers")
+
+# Exact fit of an older data version with the same key, brought up to date
+# with refit_GP instead of training from scratch. None when there is no such
+# fit or when so many rows changed that refactorizing is cheaper.
+def refresh_GP(key, version, X):
+    with gp_lock:
+        fits = [entry['fit'] for (v, k), entry in gp_cache.items() if k == key and v != version and 'fit' in entry]
+    if not fits:
+        return None
+    fit = fits[-1]
+    new = set(tuple(row) for row in X)
+    old = set(tuple(row) for row in fit['X'])
+    if len(old-new)+len(new-old) > len(X)//3:
+        return None
+    return refit_GP(fit, X)
+
+# Results of update_GP for model, from the cache when possible. method is
+# 'exact', 'sparse' (on inducing nuclei) or 'kronecker'. timings gets
+# 'cached' set to 'memory', 'disk' or False, and 'refit' when an exact fit of
+# the previous data version was updated instead of retrained.
+def cached_GP(model=default_model, timings=None, dataset='FRDM', quantity='TwoNSE', method='exact', inducing=200):
+    if timings is None:
+        timings = {}
+    check_GP(model, dataset, quantity, method, inducing)
+    model = gp_round(model)
+    key = gp_key(model, dataset, quantity, method, inducing)
+    version = gp_version()
+    with gp_lock:
+        if (version, key) in gp_cache:
+            gp_cache.move_to_end((version, key))
+            timings['cached'] = 'memory'
+            return gp_cache[(version, key)]['results']
+    entry = None
+    results = store.load_cached_array('gp', key, version)
+    if results is not None:
+        timings['cached'] = 'disk'
+        entry = {'results': results}
+    else:
+        timings['cached'] = False
+        fit = None
+        if method == 'exact':
+            t_start = time.time()
+            X, Xs = gp_tables(dataset, quantity)
+            fit = refresh_GP(key, version, X)
+        if fit is not None:
+            t_factor = time.time()
+            results = predict_fit(fit, Xs)
+            timings['refit'] = t_factor-t_start
+            timings['predict'] = time.time()-t_factor
+        elif method == 'sparse':
+            results, fit = train_sparse_GP(model, timings, dataset, quantity, int(inducing))
+        elif method == 'kronecker':
+            results, fit = train_kron_GP(model, timings, dataset, quantity)
+        else:
+            results, fit = train_GP(model, timings, dataset, quantity)
+        entry = {'results': results, 'fit': fit}
+        try:
+            store.write_cached_array('gp', key, version, results)
+        except OSError:
+            pass
+    with gp_lock:
+        for stale in [k for k in gp_cache if k[1] == key and k[0] != version]:
+            del gp_cache[stale]
+        gp_cache[(version, key)] = entry
+        while len(gp_cache) > gp_cache_size:
+            gp_cache.popitem(last=False)
+    return entry['results']
+
+# Small JSON handle on a GP result kept server-side by cached_GP. Only the
+# token goes through the browser; the default GP is gp_output
+def gp_token(model=default_model, dataset='FRDM', quantity='TwoNSE', method='exact', inducing=200):
+    check_GP(model, dataset, quantity, method, inducing)
+    return {'key': gp_key(model, dataset, quantity, method, inducing), 'model': gp_round(model),
+        'dataset': dataset, 'quantity': quantity, 'method': method, 'inducing': inducing}
+
+# Results for a token from the cache, retrained if they have been evicted
+def token_GP(token, timings=None):
+    if token is not None and not (isinstance(token, dict) and
+            all(k in token for k in ['model', 'dataset', 'quantity', 'method', 'inducing'])):
+        raise ValueError("Malformed GP token")
+    if token is not None:
+        check_GP(token['model'], token['dataset'], token['quantity'], token['method'], token['inducing'])
+    load_tables()
+    if gp_tables_version == gp_output_version and (token is None or (token['model'] == default_model and
+            token['dataset'] == 'FRDM' and token['quantity'] == 'TwoNSE' and token['method'] == 'exact')):
+        return np.asarray(gp_output)
+    if token is None:
+        token = gp_token()
+    return cached_GP(token['model'], timings, token['dataset'], token['quantity'], token['method'], token['inducing'])
 
 def gp_figure_isotopic(Z,axis_label,gp_out):
-    plotGP = []
-    for i in range(len(gp_output)):
-        if gp_out[i][1]==Z:
-            plotGP.append([gp_out[i][0],gp_out[i][3],gp_out[i][4]])
-    if not plotGP:
+    plotGP = gp_out[gp_out[:,1]==Z][:,[0,3,4]]
+    if len(plotGP) == 0:
+        return "No data for that chain!"
+    return gp_figure_chain("Isotopic Chain", "Neutrons", axis_label, plotGP)
+
+# GP mean and band along the isotonic chain N, optionally only for Z in
+# [zmin, zmax]
+def gp_figure_isotonic(N,axis_label,gp_out,zmin=None,zmax=None):
+    rows = gp_out[:,0]==N
+    if zmin is not None:
+        rows &= gp_out[:,1]>=zmin
+    if zmax is not None:
+        rows &= gp_out[:,1]<=zmax
+    plotGP = gp_out[rows][:,[1,3,4]]
+    if len(plotGP) == 0:
         return "No data for that chain!"
-    plotGP = np.array(plotGP)
+    return gp_figure_chain("Isotonic Chain", "Protons", axis_label, plotGP[np.argsort(plotGP[:,0], kind='stable')])
+
+# plotGP rows are (N or Z, GP mean, GP standard deviation)
+def gp_figure_chain(title,x_label,axis_label,plotGP):
     layout = go.Layout(
         #title=f"ROC Curve (AUC = {auc_score:.3f})",
-        title=f"Isotopic Chain",
-        xaxis=dict(title="Neutrons", gridcolor="#2f3445",title_font_size=14),
+        title=title,
+        xaxis=dict(title=x_label, gridcolor="#2f3445",title_font_size=14),
         yaxis=dict(title=axis_label, gridcolor="#2f3445",title_font_size=14),
         #legend=dict(x=0, y=1.05, orientation="h"),
         #margin=dict(l=100, r=10, t=25, b=40),
@@ -108,14 +582,14 @@ def gp_figure_isotopic(Z,axis_label,gp_out):
         go.Scatter(
             name='Mean',
             x=plotGP.T[0],
-            y=plotGP.T[1],
+            y=typed_array(plotGP.T[1]),
             mode='lines',
             line=dict(color='#e76f51'),#'rgb(100, 100, 80)'),
         ),
         go.Scatter(
             name='Upper Bound',
             x=plotGP.T[0],
-            y=plotGP.T[1]+plotGP.T[2],
+            y=typed_array(plotGP.T[1]+plotGP.T[2]),
             mode='lines',
             marker=dict(color="#444"),
             line=dict(width=0),
@@ -124,7 +598,7 @@ def gp_figure_isotopic(Z,axis_label,gp_out):
         go.Scatter(
             name='Lower Bound',
             x=plotGP.T[0],
-            y=plotGP.T[1]-plotGP.T[2],
+            y=typed_array(plotGP.T[1]-plotGP.T[2]),
             marker=dict(color="#444"),
             line=dict(width=0),
             mode='lines',
@@ -144,16 +618,8 @@ def gp_figure_isotopic(Z,axis_label,gp_out):
 
     return figure
 
-def gp_figure_isotonic():
-
-    return 4
-
 def gp_single(N, Z, gp_out):
-    out = []
-    for i in range(gp_out.shape[0]):
-        if (N == gp_out[i,0] and Z == gp_out[i,1]):
-            out = [gp_out[i,3], gp_out[i,4]]
-            break
-    if not out:
-        out = "Value not found for N="+str(N)+", Z="+str(Z)
-    return out
\ No newline at end of file
+    rows = np.nonzero((gp_out[:,0]==N) & (gp_out[:,1]==Z))[0]
+    if len(rows) == 0:
+        return "Value not found for N="+str(N)+", Z="+str(Z)
+    return [gp_out[rows[0],3], gp_out[rows[0],4]]
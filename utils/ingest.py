@@ -0,0 +1,156 @@
+import argparse
+import hashlib
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+import utils.bmex as bmex
+import utils.derived as derived
+import utils.store as store
+
+# Excel -> store pipeline (replaces utils/parser.ipynb). Each model is read
+# from its MasterNuclei.xlsx sheet, Skyrme models are completed with their
+# All_Even-Even_Nuclei.xlsx sheet, the separation energies are taken from the
+# sheet columns, everything missing is derived from the binding energies and
+# the grid is written to utils/store. Sheets are content-hashed so only the
+# sheets that changed are parsed and only their models rebuilt.
+#
+#   python -m utils.ingest --master utils/MasterNuclei.xlsx --even utils/All_Even-Even_Nuclei.xlsx
+
+# model: (MasterNuclei sheet, All_Even-Even sheet merged underneath or None)
+sheets = {
+    'EXP': ('Exp', None),
+    'ME2': ('DD-ME2_even-even_nuclei', None),
+    'MEdelta': ('DD-MEdelta_even-even_nuclei', None),
+    'PC1': ('DD-PC1_even-even_nuclei', None),
+    'NL3S': ('NL3S_even-even_nuclei', None),
+    'SKMS': ('SKMS_all_nuclei', 'SKMS_even-even_nuclei'),
+    'SKP': ('SKP_all_nuclei', 'SKP_even-even_nuclei'),
+    'SLY4': ('SLY4_all_nuclei', 'SLY4_even-even_nuclei'),
+    'SV': ('SV-MIN_all_nuclei', 'SV-MIN_even-even_nuclei'),
+    'UNEDF0': ('UNEDF0_all_nuclei', 'UNEDF0_even-even_nuclei'),
+    'UNEDF1': ('UNEDF1_all_nuclei', 'UNEDF1_even-even_nuclei'),
+}
+
+# Sheet columns holding a quantity, with the factor that brings them to the
+# stored sign convention (see utils/derived.py). Q_alpha is -S_alpha.
+sheet_columns = {
+    'OneNSE': ('S_n_(MeV)', -1.0),
+    'OnePSE': ('S_p_(MeV)', -1.0),
+    'TwoNSE': ('S_{2n}_(MeV)', -1.0),
+    'TwoPSE': ('S_{2p}_(MeV)', -1.0),
+    'AlphaSE': ('Q_{alpha}_(MeV)', 1.0),
+}
+
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Content hash of every sheet of an .xlsx workbook, read from the zip parts
+# without parsing any cells. The shared string table is part of every hash.
+# Workbooks that are not zip files get the file hash for every sheet.
+def sheet_hashes(filename):
+    try:
+        book = zipfile.ZipFile(filename)
+    except zipfile.BadZipFile:
+        digest = file_hash(filename)
+        return {name: digest for name in pd.ExcelFile(filename).sheet_names}
+    rel = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+    with book:
+        targets = {r.get('Id'): r.get('Target') for r in ET.fromstring(book.read('xl/_rels/workbook.xml.rels'))}
+        shared = book.read('xl/sharedStrings.xml') if 'xl/sharedStrings.xml' in book.namelist() else b''
+        hashes = {}
+        for sheet in ET.fromstring(book.read('xl/workbook.xml')).iter('{http://schemas.openxmlformats.org/spreadsheetml/2006/main}sheet'):
+            target = targets[sheet.get(rel)]
+            part = target.lstrip('/') if target.startswith('/') else 'xl/'+target
+            hashes[sheet.get('name')] = hashlib.sha256(book.read(part)+shared).hexdigest()
+    return hashes
+
+def frame_hash(df):
+    return hashlib.sha256(pd.util.hash_pandas_object(df.astype(str), index=False).values.tobytes()).hexdigest()
+
+# Keyed on (Z, N): values from the all-nuclei sheet win, the even-even
+# sheet fills the nuclei and columns it is missing
+def merge_sheets(all_nuclei, even_even):
+    merged = all_nuclei.set_index(["Z", "N"]).combine_first(even_even.set_index(["Z", "N"]))
+    return merged.reset_index()
+
+# Values given by the sheet win, derive_grid only fills the gaps
+def build_grid(df):
+    grid = bmex.make_grid(df)
+    Z = df["Z"].to_numpy(dtype=int)
+    N = df["N"].to_numpy(dtype=int)
+    for quan, (column, sign) in sheet_columns.items():
+        j = bmex.q_index[quan]
+        if column in df:
+            values = sign*pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=float)
+            grid[j, Z, N] = np.where(np.isnan(grid[j, Z, N]), values, grid[j, Z, N])
+    return derived.derive_grid(grid, bmex.qinput, keep=True)
+
+def ingest(master, even, path=store.STORE_DIR, force=False, log=print):
+    meta = store.read_meta(path) or {}
+    if meta.get('qinput') != bmex.qinput:
+        meta = {}
+        force = True
+    sources = meta.get('sources', {})
+    known = meta.get('sheets', {})
+
+    # Only parse the sheets whose bytes changed
+    hashes = {}
+    for book, which in [(master, 0), (even, 1)]:
+        digests = sheet_hashes(book)
+        for m in bmex.modelNames:
+            if sheets[m][which] is not None:
+                hashes[book+':'+sheets[m][which]] = digests.get(sheets[m][which])
+    def changed(m):
+        return any(known.get(book+':'+sheets[m][which]) != hashes[book+':'+sheets[m][which]]
+            for book, which in [(master, 0), (even, 1)] if sheets[m][which] is not None)
+    todo = [m for m in bmex.modelNames if force or m not in sources or changed(m)]
+    if not todo:
+        log("Store is up to date")
+        return []
+
+    t_start = time.time()
+    master_sheets = pd.read_excel(master, sheet_name=[sheets[m][0] for m in todo])
+    extra = [sheets[m][1] for m in todo if sheets[m][1] is not None]
+    even_sheets = pd.read_excel(even, sheet_name=extra) if extra else {}
+    log("Read {} sheets in {:.2f} s".format(len(master_sheets)+len(even_sheets), time.time()-t_start))
+
+    rebuilt = []
+    for m in todo:
+        df = master_sheets[sheets[m][0]]
+        if sheets[m][1] is not None:
+            df = merge_sheets(df, even_sheets[sheets[m][1]])
+        digest = frame_hash(df)
+        if not force and sources.get(m) == digest and store.has_grids([m], bmex.qinput, path):
+            continue
+        t_model = time.time()
+        store.write_grid(m, build_grid(df), path)
+        sources[m] = digest
+        rebuilt.append(m)
+        log("{}: {} nuclei in {:.1f} ms".format(m, len(df.index), (time.time()-t_model)*1000))
+
+    meta['qinput'] = bmex.qinput
+    meta['models'] = bmex.modelNames
+    meta['sources'] = sources
+    meta['sheets'] = hashes
+    meta.pop('files', None)
+    store.write_meta(meta, path)
+    return rebuilt
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the BMEX mass table store from the Excel sheets")
+    parser.add_argument('--master', default='utils/MasterNuclei.xlsx', help="workbook with one sheet per model")
+    parser.add_argument('--even', default='utils/All_Even-Even_Nuclei.xlsx', help="even-even workbook merged into the Skyrme models")
+    parser.add_argument('--out', default=store.STORE_DIR, help="store directory")
+    parser.add_argument('--force', action='store_true', help="rebuild every model")
+    args = parser.parse_args()
+    rebuilt = ingest(args.master, args.even, args.out, args.force)
+    if rebuilt:
+        print("Rebuilt "+", ".join(rebuilt))
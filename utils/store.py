@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+
+# Compact on-disk mass tables. Every model grid and every GP text table is a
+# plain .npy file, opened with np.load(mmap_mode='r') so gunicorn workers share
+# the page cache and start without parsing HDF5 or text.
+#
+#   utils/store/meta.json           quantity order of the grids
+#   utils/store/<model>.npy         (quantity, Z, N) float64 grid, NaN = missing
+#   utils/store/tables/<name>.npy   numeric text tables used by utils/gpe.py
+#   utils/store/ensemble/           cached multi-model statistics (utils/bmex.py)
+#   utils/store/cache/<kind>/<version>/   cached figures (JSON) and GP results (.npy)
+
+STORE_DIR = 'utils/store'
+
+gpe_tables = ['TwoNSEDeltaFRDM2003', 'FRDMTwoNSE', 'TwoNSE2016Full']
+
+def grid_path(model, path=STORE_DIR):
+    return os.path.join(path, model+'.npy')
+
+def table_path(name, path=STORE_DIR):
+    return os.path.join(path, 'tables', name+'.npy')
+
+def read_meta(path=STORE_DIR):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# True when the store holds a grid for every model laid out in quantity order qinput
+def has_grids(models, qinput, path=STORE_DIR):
+    meta = read_meta(path)
+    if meta is None or meta.get('qinput') != list(qinput):
+        return False
+    return all(os.path.exists(grid_path(m, path)) for m in models)
+
+def load_grid(model, path=STORE_DIR):
+    return np.load(grid_path(model, path), mmap_mode='r')
+
+# Memory-mapped table if it has been converted, otherwise parse the text file
+def load_table(name, path=STORE_DIR):
+    if os.path.exists(table_path(name, path)):
+        return np.load(table_path(name, path), mmap_mode='r')
+    return np.loadtxt('utils/'+name+'.txt')
+
+# Write through a temporary file so workers never map a half-written array
+def save_array(filename, array):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = filename+'.tmp.npy'
+    np.save(tmp, np.ascontiguousarray(array))
+    os.replace(tmp, filename)
+
+def write_grid(model, grid, path=STORE_DIR):
+    save_array(grid_path(model, path), grid)
+
+def write_meta(meta, path=STORE_DIR):
+    os.makedirs(path, exist_ok=True)
+    tmp = os.path.join(path, 'meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, os.path.join(path, 'meta.json'))
+
+def ensemble_path(name, path=STORE_DIR):
+    return os.path.join(path, 'ensemble', name+'.npy')
+
+# Ensemble grids written for data version, None when missing or stale
+def load_ensemble(names, version, path=STORE_DIR):
+    try:
+        with open(os.path.join(path, 'ensemble', 'version.txt')) as f:
+            if f.read() != version:
+                return None
+        return {n: np.load(ensemble_path(n, path), mmap_mode='r') for n in names}
+    except OSError:
+        return None
+
+def write_ensemble(grids, version, path=STORE_DIR):
+    for n in grids:
+        save_array(ensemble_path(n, path), grids[n])
+    tmp = os.path.join(path, 'ensemble', 'version.txt.tmp')
+    with open(tmp, 'w') as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(path, 'ensemble', 'version.txt'))
+
+def json_path(kind, key, version, path=STORE_DIR):
+    return os.path.join(path, 'cache', kind, version, key+'.json')
+
+def cache_array_path(kind, key, version, path=STORE_DIR):
+    return os.path.join(path, 'cache', kind, version, key+'.npy')
+
+# Creates the folder of a cache entry; entries of older data versions of the
+# same kind are removed
+def cache_folder(filename):
+    folder = os.path.dirname(filename)
+    if not os.path.isdir(folder):
+        parent = os.path.dirname(folder)
+        if os.path.isdir(parent):
+            for old in os.listdir(parent):
+                shutil.rmtree(os.path.join(parent, old), ignore_errors=True)
+        os.makedirs(folder, exist_ok=True)
+
+def load_json(kind, key, version, path=STORE_DIR):
+    try:
+        with open(json_path(kind, key, version, path)) as f:
+            return f.read()
+    except OSError:
+        return None
+
+def write_json(kind, key, version, text, path=STORE_DIR):
+    filename = json_path(kind, key, version, path)
+    cache_folder(filename)
+    tmp = filename+'.{}.tmp'.format(os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, filename)
+
+def load_cached_array(kind, key, version, path=STORE_DIR):
+    try:
+        return np.load(cache_array_path(kind, key, version, path))
+    except (OSError, ValueError):
+        return None
+
+def write_cached_array(kind, key, version, array, path=STORE_DIR):
+    filename = cache_array_path(kind, key, version, path)
+    cache_folder(filename)
+    tmp = filename+'.{}.tmp.npy'.format(os.getpid())
+    np.save(tmp, np.ascontiguousarray(array))
+    os.replace(tmp, filename)
+
+# With derive=True the derived quantities are recomputed from the binding
+# energies (utils/derived.py) instead of taken from the HDF5 columns
+def convert_h5(h5file='utils/models.h5', path=STORE_DIR, derive=False):
+    import pandas as pd
+    import utils.bmex as bmex
+    import utils.derived as derived
+    for m in bmex.modelNames:
+        grid = bmex.make_grid(pd.read_hdf(h5file, m))
+        if derive:
+            grid = derived.derive_grid(grid, bmex.qinput)
+        write_grid(m, grid, path)
+    meta = read_meta(path) or {}
+    meta['qinput'] = bmex.qinput
+    meta['models'] = bmex.modelNames
+    write_meta(meta, path)
+
+def convert_tables(path=STORE_DIR):
+    for name in gpe_tables:
+        save_array(table_path(name, path), np.loadtxt('utils/'+name+'.txt'))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the BMEX HDF5/text tables into the memory-mapped store")
+    parser.add_argument('--h5', default='utils/models.h5', help="HDF5 file with one table per model")
+    parser.add_argument('--out', default=STORE_DIR, help="store directory")
+    parser.add_argument('--derive', action='store_true', help="recompute derived quantities from the binding energies")
+    parser.add_argument('--skip-models', action='store_true', help="only convert the GP text tables")
+    args = parser.parse_args()
+    if not args.skip_models:
+        convert_h5(args.h5, args.out, args.derive)
+    convert_tables(args.out)
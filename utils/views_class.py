@@ -29,6 +29,15 @@ class View:
     #     self.attribute = value
 
     def plot(self):
+        models = figs.chain_models(self.dataset)
+        # Models picked under "Compare With" overlay on chains and single nuclei
+        selection = figs.chain_selection(self.dataset, getattr(self, 'compare', None))
         if self.graphstyle == 'single':
+            if len(figs.chain_models(selection)) > 1:
+                return html.Div(children=[figs.single(self.quantity, m, self.ZRange["protons"], self.NRange["neutrons"], self.wigner) for m in figs.chain_models(selection)])
             return figs.single(self.quantity, self.dataset, self.ZRange["protons"], self.NRange["neutrons"], self.wigner)
-        return dcc.Graph(id='graph-chains'+str(self.id), figure=getattr(figs, self.graphstyle)(self.quantity, self.dataset, self.colorbar, self.wigner, self.ZRange, self.NRange))
\ No newline at end of file
+        if self.graphstyle == 'landscape' and len(models) > 1:
+            return html.P("Model overlays are available for isotopic and isotonic chains, select a single dataset for the landscape")
+        if self.graphstyle == 'landscape':
+            return dcc.Graph(id={'type': 'landscape-graph', 'index': self.id}, figure=figs.landscape_json(self.quantity, self.dataset, self.colorbar, self.wigner, self.ZRange, self.NRange, getattr(self, 'nuclei', 'even')))
+        return dcc.Graph(id='graph-chains'+str(self.id), figure=getattr(figs, self.graphstyle)(self.quantity, selection, self.colorbar, self.wigner, self.ZRange, self.NRange))
\ No newline at end of file